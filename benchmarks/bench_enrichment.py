@@ -0,0 +1,55 @@
+import contextlib
+import io
+import time
+
+import click
+import pandas as pd
+
+from benchmarks.mock_api_server import MockAPIServer
+from src.api_integrator import APIIntegrator
+from src.enrichment_engine import EnrichmentEngine
+
+# Compares sequential and concurrent enrichment against the local mock API server.
+#
+#     python -m benchmarks.bench_enrichment --rows 200 --latency 0.05 --concurrency 1 --concurrency 16
+
+UNLIMITED = {
+    'sp_api': {'rate': None, 'max_in_flight': None},
+    'keepa': {'rate': None, 'max_in_flight': None},
+    'jungle_scout': {'rate': None, 'max_in_flight': None},
+}
+
+def make_supplier_df(rows):
+    return pd.DataFrame({
+        'barcode': [f'50000000{i:05d}' for i in range(rows)],
+        'buy_price': [5.0 + (i % 10) for i in range(rows)],
+    })
+
+def run_once(base_url, supplier_df, concurrency):
+    api_integrator = APIIntegrator(
+        'amazon-key', 'keepa-key', 'jungle-scout-key',
+        sp_api_base_url=base_url, keepa_base_url=base_url, jungle_scout_base_url=base_url
+    )
+    engine = EnrichmentEngine(api_integrator, concurrency=concurrency, limits=UNLIMITED)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # Silence per-row echo
+        results = engine.enrich(supplier_df)
+    elapsed = time.perf_counter() - start
+
+    assert [r['barcode'] for r in results] == list(supplier_df['barcode']), "Output order changed"
+    return elapsed
+
+@click.command()
+@click.option('--rows', default=200, show_default=True, help='Number of supplier rows to enrich.')
+@click.option('--latency', default=0.05, show_default=True, help='Simulated per-request latency in seconds.')
+@click.option('--concurrency', 'concurrency_levels', multiple=True, type=int, default=(1, 8, 32), show_default=True, help='Concurrency levels to compare.')
+def main(rows, latency, concurrency_levels):
+    supplier_df = make_supplier_df(rows)
+    with MockAPIServer(latency=latency) as server:
+        for concurrency in concurrency_levels:
+            elapsed = run_once(server.base_url, supplier_df, concurrency)
+            click.echo(f"concurrency={concurrency:<4} rows={rows} elapsed={elapsed:.2f}s rows/sec={rows / elapsed:.1f}")
+
+if __name__ == '__main__':
+    main()
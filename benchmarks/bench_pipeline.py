@@ -0,0 +1,158 @@
+import contextlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_enrichment import UNLIMITED
+from benchmarks.mock_api_server import MockAPIServer, asin_for_barcode
+from src.api_integrator import APIIntegrator
+from src.enrichment_engine import EnrichmentEngine
+from src.http_client import HTTPClient, RetryPolicy
+from src.image_matcher import ImageMatcher
+from src.image_store import ImageStore
+from src.instrumentation import Instrumentation
+from src.keepa_history import KeepaHistoryStore
+from src.profit_calculator import ProfitCalculator
+from src.streaming_pipeline import StreamingPipeline
+
+# End-to-end throughput of the file pipeline (src/main.gpy process_supplier_data) against
+# the local mock APIs: barcode lookup, Keepa batches, per-row SP-API and Jungle Scout calls,
+# Keepa history stats, scoring, image download and matching, and chunked Parquet output.
+# Each size runs in a fresh process so the peak RSS reported is that run's own; the mock
+# server runs in this process.
+#
+#     python -m benchmarks.bench_pipeline --rows 1000 --rows 10000 --rows 100000
+#     python -m benchmarks.bench_pipeline --rows 10000 --throttle-rate 0.02 --save baseline.json
+#     python -m benchmarks.bench_pipeline --rows 10000 --compare baseline.json
+#
+# rows/s is supplier rows per second of wall time; p95 row latency is the 95th percentile
+# of the time taken to enrich a single row (its SP-API and Jungle Scout calls, including
+# rate-limit waits and retries).
+
+MISMATCH_SHARE = 0.1 # Supplier rows whose image shows a different product
+
+def make_supplier_csv(path, rows, base_url, images=True, seed=0):
+    rng = np.random.default_rng(seed)
+    barcodes = [f'50{i:011d}' for i in range(rows)]
+    supplier_df = pd.DataFrame({
+        'barcode': barcodes,
+        'buy_price': np.round(rng.uniform(2, 30, rows), 2),
+        'vat_rate': rng.choice([0.2, 0.2, 0.2, 0.0], rows),
+    })
+    if images:
+        # Supplier photos are re-shots of the Amazon image, or of another product
+        shown = [asin_for_barcode(barcodes[(i + 1) % rows] if mismatch else barcode)
+                 for i, (barcode, mismatch) in enumerate(zip(barcodes, rng.random(rows) < MISMATCH_SHARE))]
+        supplier_df['supplier_image_url'] = [f'{base_url}/images/{asin}.png?variant=1' for asin in shown]
+    supplier_df.to_csv(path, index=False)
+
+def run_size(base_url, rows, concurrency, chunksize, images, seed, min_roi=None, min_margin=None):
+    with tempfile.TemporaryDirectory() as directory:
+        supplier_file = os.path.join(directory, 'supplier.csv')
+        make_supplier_csv(supplier_file, rows, base_url, images=images, seed=seed)
+        instrumentation = Instrumentation('quiet')
+        # Short backoff so injected 429s and 500s cost retries, not benchmark minutes
+        http_client = HTTPClient(retry_policy=RetryPolicy(backoff_base=0.05, backoff_max=1.0), pool_maxsize=max(concurrency, 10), instrumentation=instrumentation)
+        keepa_history = KeepaHistoryStore(os.path.join(directory, 'keepa'))
+        api_integrator = APIIntegrator(
+            'amazon-key', 'keepa-key', 'jungle-scout-key', http_client=http_client, keepa_history=keepa_history, instrumentation=instrumentation,
+            sp_api_base_url=base_url, keepa_base_url=base_url, jungle_scout_base_url=base_url
+        )
+        image_store = ImageStore(os.path.join(directory, 'images'), http_client=http_client) if images else None
+        image_matcher = ImageMatcher(image_store=image_store, instrumentation=instrumentation) if images else None
+        profit_calculator = ProfitCalculator(instrumentation=instrumentation)
+        pipeline = StreamingPipeline(
+            EnrichmentEngine(api_integrator, concurrency=concurrency, limits=UNLIMITED, profit_calculator=profit_calculator, min_roi=min_roi, min_margin=min_margin),
+            profit_calculator,
+            image_matcher=image_matcher,
+            chunksize=chunksize,
+            image_store=image_store,
+            keepa_history=keepa_history,
+            instrumentation=instrumentation
+        )
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = pipeline.run(supplier_file, os.path.join(directory, 'results.parquet'))
+        elapsed = time.perf_counter() - start
+        if image_store:
+            image_matcher.close()
+            image_store.close()
+        http_client.close()
+
+    summary = instrumentation.summary()
+    endpoints = summary['endpoints'].values()
+    return {
+        'rows': rows,
+        'rows_written': stats['rows_written'],
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed, 1),
+        'p95_row_latency': summary['rows']['latency_seconds'].get('p95'),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # kilobytes on Linux
+        'requests': sum(endpoint['requests'] for endpoint in endpoints),
+        'retries': sum(endpoint['retries'] for endpoint in endpoints),
+        'errors': sum(endpoint['errors'] for endpoint in endpoints),
+        'rows_pruned': summary['counters'].get('rows_pruned', 0),
+        'stages': {name: stage['seconds'] for name, stage in summary['stages'].items()},
+    }
+
+def _change(current, baseline, key):
+    if not baseline or not baseline.get(key) or current.get(key) is None:
+        return ''
+    return f" ({(current[key] / baseline[key] - 1) * 100:+.0f}%)"
+
+@click.command()
+@click.option('--rows', 'row_counts', multiple=True, type=int, default=(1000, 10000, 100000), show_default=True, help='Supplier file sizes to benchmark.')
+@click.option('--latency', default=0.02, show_default=True, help='Simulated per-request latency in seconds.')
+@click.option('--latency-jitter', default=0.01, show_default=True, help='Up to this many seconds of extra random latency per request.')
+@click.option('--throttle-rate', default=0.0, show_default=True, type=click.FloatRange(0, 1), help='Share of API requests answered with 429.')
+@click.option('--error-rate', default=0.0, show_default=True, type=click.FloatRange(0, 1), help='Share of API requests answered with 500.')
+@click.option('--concurrency', default=32, show_default=True, type=click.IntRange(min=1), help='Rows enriched concurrently.')
+@click.option('--chunksize', default=5000, show_default=True, type=click.IntRange(min=1), help='Supplier rows per pipeline chunk.')
+@click.option('--min-roi', default=0.0, show_default=True, help='Best-case ROI (%) floor for pruning rows before Keepa and Jungle Scout.')
+@click.option('--min-margin', default=0.0, show_default=True, help='Best-case margin (%) floor for pruning rows before Keepa and Jungle Scout.')
+@click.option('--no-prune', is_flag=True, help='Send every row to Keepa and Jungle Scout.')
+@click.option('--images/--no-images', default=True, show_default=True, help='Download and match product images.')
+@click.option('--seed', default=0, show_default=True, help='Seed for the mock catalogue and the supplier file.')
+@click.option('--save', 'save_file', help='Write the results as JSON, to compare later runs against.')
+@click.option('--compare', 'baseline_file', type=click.Path(exists=True), help='JSON results of an earlier run (from --save) to compare against.')
+def main(row_counts, latency, latency_jitter, throttle_rate, error_rate, concurrency, chunksize, min_roi, min_margin, no_prune, images, seed, save_file, baseline_file):
+    baseline = {}
+    if baseline_file:
+        with open(baseline_file, encoding='utf-8') as handle:
+            baseline = {result['rows']: result for result in json.load(handle)['results']}
+
+    results = []
+    with MockAPIServer(latency=latency, latency_jitter=latency_jitter, throttle_rate=throttle_rate, error_rate=error_rate, seed=seed, miss_rate=0.05) as server:
+        for rows in row_counts:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                floors = (None, None) if no_prune else (min_roi, min_margin)
+                result = executor.submit(run_size, server.base_url, rows, concurrency, chunksize, images, seed, *floors).result()
+            results.append(result)
+            previous = baseline.get(rows)
+            click.echo(
+                f"rows={rows:<8} {result['rows_per_second']:>8.1f} rows/s{_change(result, previous, 'rows_per_second')}"
+                f"  p95_row_latency={result['p95_row_latency'] or 0:.3f}s{_change(result, previous, 'p95_row_latency')}"
+                f"  peak_rss={result['peak_rss_mb']:.0f}MB{_change(result, previous, 'peak_rss_mb')}"
+                f"  requests={result['requests']} retries={result['retries']} errors={result['errors']} pruned={result['rows_pruned']}"
+            )
+            click.echo("    " + ' '.join(f"{name}={seconds:.1f}s" for name, seconds in result['stages'].items()))
+
+    if save_file:
+        settings = {'latency': latency, 'latency_jitter': latency_jitter, 'throttle_rate': throttle_rate, 'error_rate': error_rate,
+                    'concurrency': concurrency, 'chunksize': chunksize, 'min_roi': None if no_prune else min_roi,
+                    'min_margin': None if no_prune else min_margin, 'images': images, 'seed': seed}
+        with open(save_file, 'w', encoding='utf-8') as handle:
+            json.dump({'settings': settings, 'results': results}, handle, indent=2)
+        click.echo(f"Results written to {save_file}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import contextlib
+import io
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.report_generator import ReportGenerator, DEFAULT_FORMATS
+
+# Times report generation per output format on synthetic scored results.
+# Each size runs in a fresh process so the peak RSS reported is that run's own.
+#
+#     python -m benchmarks.bench_report --rows 10000 --rows 100000 --rows 500000
+
+def make_results_df(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    buy_box_price = np.round(rng.uniform(5, 60, rows), 2)
+    supplier_buy_price = np.round(buy_box_price * rng.uniform(0.3, 0.9, rows), 2)
+    profit = np.round(buy_box_price * 0.85 - supplier_buy_price - 2.85, 2)
+    return pd.DataFrame({
+        'barcode': [f'50{i:011d}' for i in range(rows)],
+        'supplier_buy_price': supplier_buy_price,
+        'asin': [f'B0{i:08d}' for i in range(rows)],
+        'title': [f'Product {i}' for i in range(rows)],
+        'buy_box_price': buy_box_price,
+        'fba_fee': 2.85,
+        'referral_fee_percentage': 0.15,
+        'profit': profit,
+        'profit_percentage': np.round(profit / buy_box_price * 100, 2),
+        'roi': np.round(profit / supplier_buy_price * 100, 2),
+        'estimated_monthly_sales': rng.integers(0, 500, rows),
+        'number_of_sellers': rng.integers(1, 20, rows),
+        'recommended_units': rng.integers(0, 100, rows),
+        'keepa_data': [
+            {'buy_box_history': [int(t) for t in rng.integers(3000, 6000, 8)], 'estimated_sales_velocity': int(rank), 'competitive_sellers': int(rank % 7)}
+            for rank in rng.integers(1000, 90000, rows)
+        ],
+        'jungle_scout_data': [
+            {'estimated_monthly_sales': int(sales), 'number_of_sellers': int(sales % 9), 'opportunity_score': int(sales % 10)}
+            for sales in rng.integers(0, 500, rows)
+        ],
+    })
+
+def run_size(rows, formats):
+    results_df = make_results_df(rows)
+    timings = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for output_format in formats:
+            output_file = os.path.join(directory, 'report.xlsx')
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ReportGenerator().generate_report(results_df, output_file, formats=(output_format,))
+            timings[output_format] = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+    return timings, peak_rss_mb
+
+@click.command()
+@click.option('--rows', 'row_counts', multiple=True, type=int, default=(10000, 100000, 500000), show_default=True, help='Report sizes to benchmark.')
+@click.option('--format', 'formats', multiple=True, type=click.Choice(DEFAULT_FORMATS), default=DEFAULT_FORMATS, show_default=True, help='Formats to time.')
+def main(row_counts, formats):
+    for rows in row_counts:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            timings, peak_rss_mb = executor.submit(run_size, rows, formats).result()
+        per_format = ' '.join(f"{name}={elapsed:.2f}s" for name, elapsed in timings.items())
+        click.echo(f"rows={rows:<8} {per_format} peak_rss={peak_rss_mb:.0f}MB")
+
+if __name__ == '__main__':
+    main()
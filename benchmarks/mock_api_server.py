@@ -0,0 +1,285 @@
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+from src.keepa_history import KEEPA_EPOCH_MINUTES, MINUTES_PER_DAY
+
+# Local stand-in for SP-API (catalog items, fees estimate), Keepa (/product) and Jungle
+# Scout, returning payloads in the shapes APIIntegrator parses. Used by the benchmarks and
+# for running the pipeline end to end without API keys:
+#
+#     with MockAPIServer(latency=0.02, throttle_rate=0.01) as server:
+#         APIIntegrator('key', 'key', 'key', sp_api_base_url=server.base_url,
+#                       keepa_base_url=server.base_url, jungle_scout_base_url=server.base_url)
+#
+# Payloads are derived from `seed` and the ASIN alone, so every run sees the same catalogue:
+# prices, fees, sales ranks, Keepa price/rank/buy box histories and Jungle Scout estimates
+# are stable per ASIN but vary realistically across ASINs. Barcodes map to ASINs as
+# B0 + the last 8 digits; a `miss_rate` share of barcodes is unknown to Keepa. Product
+# images are served from /images/<asin>.png (`?variant=N` gives a re-shot of the same
+# product, as a supplier photo would be).
+#
+# Faults, drawn per request: `throttle_rate` answers 429 with a Retry-After header,
+# `error_rate` answers 500. Every request sleeps `latency` seconds plus up to
+# `latency_jitter` more, to simulate network round trips.
+
+SELLER_POOL = [f'A{index:013d}' for index in range(40)]
+KEEPA_TOKEN_BUDGET = 1000000
+
+def _rng(seed, *keys):
+    # Stable across processes and Python versions (unlike hash())
+    return random.Random(zlib.crc32(':'.join(str(key) for key in (seed,) + keys).encode('utf-8')))
+
+def asin_for_barcode(barcode):
+    return f'B0{str(barcode)[-8:]:0>8}'
+
+class MockCatalog:
+    def __init__(self, seed=0, history_days=180, miss_rate=0.0):
+        self.seed = seed
+        self.history_days = history_days
+        self.miss_rate = miss_rate
+        self.now_minutes = int(time.time() // 60) - KEEPA_EPOCH_MINUTES
+
+    def knows_barcode(self, barcode):
+        return _rng(self.seed, 'barcode', barcode).random() >= self.miss_rate
+
+    def product(self, asin):
+        rng = _rng(self.seed, 'product', asin)
+        buy_box = round(rng.uniform(4.0, 60.0), 2)
+        rank = int(rng.lognormvariate(9.5, 1.2)) + 1
+        return {
+            'asin': asin,
+            'buy_box_price': buy_box,
+            'sales_rank': rank,
+            'fba_fee': round(2.2 + 0.03 * buy_box + rng.choice((0.0, 0.0, 0.6, 1.5)), 2), # Size tiers
+            'referral_fee': round(buy_box * rng.choice((0.08, 0.15, 0.15, 0.15)), 2),
+            'estimated_sales': int(max(0, 90000 / rank ** 0.6 + rng.gauss(0, 5))),
+            'seller_count': rng.randint(1, 20),
+            'opportunity_score': rng.randint(1, 10),
+        }
+
+    def catalog_item(self, asin, base_url):
+        product = self.product(asin)
+        return {
+            'asin': asin,
+            'attributes': {'item_name': [{'value': f'Product {asin}'}]},
+            'summaries': [{'buyBoxPrice': {'amount': product['buy_box_price'], 'currencyCode': 'GBP'}}],
+            'salesRanks': [{'rank': product['sales_rank']}],
+            'images': {'main': {'link': f'{base_url}/images/{asin}.png'}},
+        }
+
+    def fees_estimate(self, asin):
+        product = self.product(asin)
+        return {'FeesEstimateResult': {'Status': 'Success', 'FeesEstimate': {'Fees': [
+            {'FeeType': 'FBAFees', 'FeeAmount': {'CurrencyCode': 'GBP', 'Amount': product['fba_fee']}},
+            {'FeeType': 'ReferralFee', 'FeeAmount': {'CurrencyCode': 'GBP', 'Amount': product['referral_fee']}},
+        ]}}}
+
+    def jungle_scout(self, asin):
+        product = self.product(asin)
+        return {'data': [{
+            'asin': asin,
+            'estimated_sales': product['estimated_sales'],
+            'seller_count': product['seller_count'],
+            'opportunity_score': product['opportunity_score'],
+        }]}
+
+    def keepa_product(self, asin, code=None):
+        # Random walks ending at the current catalog values, one point every few hours
+        product = self.product(asin)
+        rng = np.random.default_rng(zlib.crc32(f'{self.seed}:keepa:{asin}'.encode('utf-8')))
+        start = self.now_minutes - self.history_days * MINUTES_PER_DAY
+        points = int(rng.integers(self.history_days // 2, self.history_days * 3))
+        times = np.sort(rng.integers(start, self.now_minutes, points))
+
+        # Walk backwards from today's price and rank, then put the points oldest first
+        price = np.maximum(100, product['buy_box_price'] * 100 * np.cumprod(rng.uniform(0.97, 1.03, points))[::-1]).astype(np.int64)
+        rank = np.maximum(1, product['sales_rank'] * np.cumprod(rng.uniform(0.9, 1.12, points))[::-1]).astype(np.int64)
+        amazon = np.where(rng.random(points) > 0.3, price + rng.integers(-50, 150, points), -1)
+        sellers = rng.choice(SELLER_POOL, min(len(SELLER_POOL), product['seller_count']), replace=False)
+        weights = rng.pareto(1.5, len(sellers)) + 1
+        holders = rng.choice(sellers, points, p=weights / weights.sum())
+
+        buy_box = np.empty(points * 3, dtype=object)
+        buy_box[0::3], buy_box[1::3], buy_box[2::3] = times.tolist(), price.tolist(), holders.tolist()
+        return {
+            'asin': asin,
+            'eanList': [code] if code else [],
+            # Keepa's flattened [time, value(, seller), ...] lists
+            'data': {
+                'AMAZON': np.column_stack([times, amazon]).ravel().tolist(),
+                'SALES_RANK': np.column_stack([times, rank]).ravel().tolist(),
+                'BUY_BOX': buy_box.tolist(),
+            },
+            'stats': {'avg180': {'salesRank': product['sales_rank']}},
+        }
+
+    def image(self, asin, variant=0):
+        # A few seeded shapes on a plain background; variants are shifted, rescaled and
+        # re-exposed copies of the same product, like a second photo of it
+        rng = _rng(self.seed, 'image', asin)
+        image = np.full((240, 240, 3), 235, dtype=np.uint8)
+        for _ in range(6):
+            colour = tuple(rng.randint(0, 200) for _ in range(3))
+            x, y, size = rng.randint(20, 180), rng.randint(20, 180), rng.randint(15, 60)
+            if rng.random() < 0.5:
+                cv2.rectangle(image, (x, y), (x + size, y + size // 2), colour, -1)
+            else:
+                cv2.circle(image, (x, y), size // 2, colour, -1)
+        cv2.putText(image, asin[-4:], (20, 225), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (20, 20, 20), 2)
+        if variant:
+            shot = _rng(self.seed, 'variant', asin, variant)
+            scale, shift = shot.uniform(0.9, 1.1), (shot.randint(-8, 8), shot.randint(-8, 8))
+            matrix = np.float32([[scale, 0, shift[0]], [0, scale, shift[1]]])
+            image = cv2.warpAffine(image, matrix, (240, 240), borderValue=(235, 235, 235))
+            image = cv2.convertScaleAbs(image, alpha=shot.uniform(0.9, 1.1), beta=shot.randint(-10, 10))
+        return cv2.imencode('.png', image)[1].tobytes()
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer headers and body into one write and disable Nagle, otherwise keep-alive
+    # clients stall on delayed ACKs and the benchmark measures TCP, not the pipeline.
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass # Keep benchmark output readable
+
+    def _send(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(self.endpoint, status)
+
+    def _send_json(self, payload, status=200, headers=None):
+        self._send(json.dumps(payload).encode('utf-8'), 'application/json', status, headers)
+
+    def _fault(self):
+        # Simulated latency, then an injected 429 or 500 if this request draws one
+        latency = self.server.latency
+        if self.server.latency_jitter:
+            latency += self.server.random() * self.server.latency_jitter
+        if latency:
+            time.sleep(latency)
+        draw = self.server.random()
+        if draw < self.server.throttle_rate:
+            self._send_json({'errors': [{'code': 'QuotaExceeded', 'message': 'You exceeded your quota for the requested resource.'}]},
+                            status=429, headers={'Retry-After': f'{self.server.retry_after:g}'})
+            return True
+        if draw < self.server.throttle_rate + self.server.error_rate:
+            self._send_json({'errors': [{'code': 'InternalFailure', 'message': 'We encountered an internal error.'}]}, status=500)
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        catalog = self.server.catalog
+        self.endpoint = _endpoint(url.path, query)
+
+        if self.endpoint != 'image' and self._fault():
+            return
+        if self.endpoint == 'catalog':
+            self._send_json(catalog.catalog_item(url.path.rsplit('/', 1)[-1], f"http://{self.headers.get('Host')}"))
+        elif self.endpoint == 'keepa':
+            # Keepa accepts comma-separated lists of codes or ASINs and bills one token per product
+            codes = [code for code in query.get('code', [''])[0].split(',') if code and catalog.knows_barcode(code)]
+            asins = [asin for asin in query.get('asin', [''])[0].split(',') if asin]
+            products = [catalog.keepa_product(asin_for_barcode(code), code) for code in codes]
+            products += [catalog.keepa_product(asin) for asin in asins]
+            self._send_json({'products': products, **self.server.spend_keepa_tokens(len(products))})
+        elif self.endpoint == 'jungle_scout':
+            self._send_json(catalog.jungle_scout(query.get('asin', [''])[0]))
+        elif self.endpoint == 'image':
+            asin = url.path.rsplit('/', 1)[-1].split('.')[0]
+            self._send(catalog.image(asin, int(query.get('variant', ['0'])[0])), 'image/png')
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.endpoint = _endpoint(self.path, {})
+        if self._fault():
+            return
+        if self.endpoint == 'fees':
+            request = json.loads(body or b'{}').get('FeesEstimateRequest', {})
+            self._send_json(self.server.catalog.fees_estimate(request.get('Identifier', '')))
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+def _endpoint(path, query):
+    if path.startswith('/catalog/2022-04-01/items/'):
+        return 'catalog'
+    if path.startswith('/fees/v0/products/feesEstimate'):
+        return 'fees'
+    if path == '/product':
+        return 'keepa'
+    if path == '/api/v1/products':
+        return 'jungle_scout'
+    if path.startswith('/images/'):
+        return 'image'
+    return 'unknown'
+
+
+class MockAPIServer:
+    # Runs the mock APIs on a background thread. `requests` counts the responses sent per
+    # (endpoint, status), e.g. requests[('catalog', 429)].
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, latency_jitter=0.0, throttle_rate=0.0, error_rate=0.0, retry_after=0.05,
+                 seed=0, miss_rate=0.0, history_days=180):
+        self.httpd = ThreadingHTTPServer((host, port), MockAPIHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.latency_jitter = latency_jitter
+        self.httpd.throttle_rate = throttle_rate
+        self.httpd.error_rate = error_rate
+        self.httpd.retry_after = retry_after
+        self.httpd.catalog = MockCatalog(seed, history_days=history_days, miss_rate=miss_rate)
+        self.requests = Counter()
+        self._keepa_tokens_left = KEEPA_TOKEN_BUDGET
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd.record = self._record
+        self.httpd.random = self._draw
+        self.httpd.spend_keepa_tokens = self._spend_keepa_tokens
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _record(self, endpoint, status):
+        with self._lock:
+            self.requests[(endpoint, status)] += 1
+
+    def _draw(self):
+        with self._lock:
+            return self._random.random()
+
+    def _spend_keepa_tokens(self, products):
+        with self._lock:
+            self._keepa_tokens_left -= products
+            return {'tokensConsumed': products, 'tokensLeft': self._keepa_tokens_left}
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
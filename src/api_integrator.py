@@ -1,21 +1,78 @@
-import click
+import numpy as np
 import requests
 import os
+import threading
+from contextlib import contextmanager
+from src.http_client import HTTPClient
+from src.instrumentation import Instrumentation
+from src.keepa_history import decode_product, competitive_sellers
 
 class APIIntegrator:
-    def __init__(self, amazon_api_key=None, keepa_api_key=None, jungle_scout_api_key=None):
+    SP_API_BASE_URL = "https://sellingpartnerapi-eu.amazon.com" # Example for EU region
+    KEEPA_BASE_URL = "https://api.keepa.com"
+    JUNGLE_SCOUT_BASE_URL = "https://api.junglescout.com"
+    KEEPA_BATCH_SIZE = 100 # Keepa accepts up to 100 comma-separated ASINs or codes per /product call
+
+    def __init__(self, amazon_api_key=None, keepa_api_key=None, jungle_scout_api_key=None, rate_limiters=None, cache=None, http_client=None, keepa_history=None, instrumentation=None,
+                 sp_api_base_url=None, keepa_base_url=None, jungle_scout_base_url=None):
         self.amazon_api_key = amazon_api_key or os.getenv('AMAZON_API_KEY')
         self.keepa_api_key = keepa_api_key or os.getenv('KEEPA_API_KEY')
         self.jungle_scout_api_key = jungle_scout_api_key or os.getenv('JUNGLE_SCOUT_API_KEY')
+        # Base URLs default to the production APIs; override them (or set the environment
+        # variables of the same name) to point a run at a proxy or at benchmarks/mock_api_server.py
+        self.SP_API_BASE_URL = (sp_api_base_url or os.getenv('SP_API_BASE_URL') or self.SP_API_BASE_URL).rstrip('/')
+        self.KEEPA_BASE_URL = (keepa_base_url or os.getenv('KEEPA_BASE_URL') or self.KEEPA_BASE_URL).rstrip('/')
+        self.JUNGLE_SCOUT_BASE_URL = (jungle_scout_base_url or os.getenv('JUNGLE_SCOUT_BASE_URL') or self.JUNGLE_SCOUT_BASE_URL).rstrip('/')
+        # Optional per-upstream limiters ('sp_api', 'keepa', 'jungle_scout'), see src/rate_limiter.py
+        self.rate_limiters = rate_limiters or {}
+        # Optional ResponseCache (src/response_cache.py). Raw responses are cached, never API keys.
+        self.cache = cache
+        # Run metrics and levelled logging (src/instrumentation.py), shared with the HTTP client
+        self.instrumentation = instrumentation or Instrumentation()
+        # Pooled keep-alive sessions per host with retry/backoff on 429 and 5xx, see src/http_client.py
+        self.http_client = http_client or HTTPClient(instrumentation=self.instrumentation)
+        # Optional KeepaHistoryStore (src/keepa_history.py). When set, Keepa price and rank
+        # histories are decoded into its per-ASIN files instead of being kept as lists in keepa_data.
+        self.keepa_history = keepa_history
+        self._error_tracking = threading.local()
+
+    @contextmanager
+    def track_errors(self):
+        # Collects the API errors raised (and swallowed) by calls made on this thread inside
+        # the block, so callers can tell "no data" apart from "the API call failed".
+        errors = []
+        self._error_tracking.errors = errors
+        try:
+            yield errors
+        finally:
+            self._error_tracking.errors = None
+
+    def _record_error(self, endpoint, error, keys=None):
+        self.instrumentation.record_error(endpoint)
+        errors = getattr(self._error_tracking, 'errors', None)
+        if errors is not None:
+            errors.append({'endpoint': endpoint, 'error': str(error), 'keys': list(keys or [])})
+
+    def _record_keepa_tokens(self, data):
+        # Every Keepa response reports the tokens the request cost and the tokens left
+        if isinstance(data, dict):
+            self.instrumentation.record_keepa_tokens(data.get('tokensConsumed'), data.get('tokensLeft'))
+
+    def _cache_get(self, data_class, endpoint, params):
+        return self.cache.get(data_class, endpoint, params) if self.cache else None
+
+    def _cache_set(self, data_class, endpoint, params, value):
+        if self.cache:
+            self.cache.set(data_class, endpoint, params, value)
 
     def get_amazon_product_data(self, asin):
-        click.echo(f"  Integrating with Amazon SP-API for ASIN: {asin}...")
+        self.instrumentation.log(f"  Integrating with Amazon SP-API for ASIN: {asin}...")
         if not self.amazon_api_key:
-            click.echo("    Amazon API Key not provided. Skipping Amazon integration.")
+            self.instrumentation.log("    Amazon API Key not provided. Skipping Amazon integration.")
             return {}
 
         # Endpoint for Catalog Items API (v2022-04-01) to get item details by ASIN.
-        amazon_api_url = f"https://sellingpartnerapi-eu.amazon.com/catalog/2022-04-01/items/{asin}" # Example for EU region
+        amazon_api_url = f"{self.SP_API_BASE_URL}/catalog/2022-04-01/items/{asin}"
         headers = {
             "x-amz-access-token": self.amazon_api_key,
             "Content-Type": "application/json"
@@ -25,9 +82,13 @@ class APIIntegrator:
         }
 
         try:
-            response = requests.get(amazon_api_url, headers=headers, params=params)
-            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-            data = response.json()
+            cache_params = {"asin": asin, **params}
+            data = self._cache_get('catalog', 'catalog/2022-04-01/items', cache_params)
+            if data is None:
+                response = self.http_client.get(amazon_api_url, endpoint='catalog', limiter=self.rate_limiters.get('sp_api'), headers=headers, params=params)
+                response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+                data = response.json()
+                self._cache_set('catalog', 'catalog/2022-04-01/items', cache_params, data)
 
             amazon_data = {
                 'asin': data.get('asin'),
@@ -42,51 +103,64 @@ class APIIntegrator:
             if buy_box_price:
                 fees = self.get_amazon_fees(asin, buy_box_price, params["marketplaceIds"])
                 amazon_data['fba_fee'] = fees.get('fba_fee')
-                amazon_data['referral_fee'] = fees.get('referral_fee')
+                # The fees API returns the referral fee as an amount; downstream it is a
+                # percentage of the buy box price so it can be re-applied at other prices.
+                referral_fee = fees.get('referral_fee')
+                amazon_data['referral_fee'] = referral_fee / buy_box_price if referral_fee is not None else None
 
             return amazon_data
 
         except requests.exceptions.RequestException as e:
-            click.echo(f"    Error during Amazon SP-API call: {e}")
+            self.instrumentation.log(f"    Error during Amazon SP-API call: {e}")
+            self._record_error('catalog', e)
             return {}
         # --- END AMAZON SP-API CATALOG ITEMS INTEGRATION ---
 
     def get_asin_from_barcode(self, barcode, domain=3):
-        click.echo(f"  Attempting to get ASIN from barcode {barcode} using Keepa API...")
+        self.instrumentation.log(f"  Attempting to get ASIN from barcode {barcode} using Keepa API...")
         if not self.keepa_api_key:
-            click.echo("    Keepa API Key not provided. Cannot convert barcode to ASIN.")
+            self.instrumentation.log("    Keepa API Key not provided. Cannot convert barcode to ASIN.")
             return None
 
         # Keepa API endpoint for product lookup by barcode
-        keepa_api_url = f"https://api.keepa.com/product?key={self.keepa_api_key}&code={barcode}&domain={domain}"
+        keepa_api_url = f"{self.KEEPA_BASE_URL}/product?key={self.keepa_api_key}&code={barcode}&domain={domain}"
+
+        cache_params = {"code": barcode, "domain": domain}
+        asin = self._cache_get('barcode', 'keepa/product', cache_params)
+        if asin:
+            self.instrumentation.log(f"    Found ASIN: {asin} for barcode: {barcode} (cached)")
+            return asin
 
         try:
-            response = requests.get(keepa_api_url)
+            response = self.http_client.get(keepa_api_url, endpoint='keepa_barcode', limiter=self.rate_limiters.get('keepa'))
             response.raise_for_status()
             data = response.json()
+            self._record_keepa_tokens(data)
 
             # Check if products are returned and extract ASIN
             products = data.get('products')
             if products and len(products) > 0:
                 asin = products[0].get('asin')
                 if asin:
-                    click.echo(f"    Found ASIN: {asin} for barcode: {barcode}")
+                    self.instrumentation.log(f"    Found ASIN: {asin} for barcode: {barcode}")
+                    self._cache_set('barcode', 'keepa/product', cache_params, asin)
                     return asin
-            click.echo(f"    No ASIN found for barcode: {barcode}")
+            self.instrumentation.log(f"    No ASIN found for barcode: {barcode}")
             return None
 
         except requests.exceptions.RequestException as e:
-            click.echo(f"    Error during Keepa API barcode-to-ASIN conversion: {e}")
+            self.instrumentation.log(f"    Error during Keepa API barcode-to-ASIN conversion: {e}")
+            self._record_error('keepa_barcode', e, [barcode])
             return None
 
     def get_amazon_fees(self, asin, price, marketplace_id="A1F83G8C2ARO7P"):
-        click.echo(f"  Integrating with Amazon SP-API Product Fees for ASIN: {asin}...")
+        self.instrumentation.log(f"  Integrating with Amazon SP-API Product Fees for ASIN: {asin}...")
         if not self.amazon_api_key:
-            click.echo("    Amazon API Key not provided. Skipping Amazon fees integration.")
+            self.instrumentation.log("    Amazon API Key not provided. Skipping Amazon fees integration.")
             return {"fba_fee": None, "referral_fee": None}
 
         # Endpoint for Product Fees API (v0) to get fee estimates.
-        fees_api_url = f"https://sellingpartnerapi-eu.amazon.com/fees/v0/products/feesEstimate"
+        fees_api_url = f"{self.SP_API_BASE_URL}/fees/v0/products/feesEstimate"
         headers = {
             "x-amz-access-token": self.amazon_api_key,
             "Content-Type": "application/json"
@@ -106,9 +180,13 @@ class APIIntegrator:
         }
 
         try:
-            response = requests.post(fees_api_url, headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
+            cache_params = {"asin": asin, "price": price, "marketplaceId": marketplace_id}
+            data = self._cache_get('fees', 'fees/v0/products/feesEstimate', cache_params)
+            if data is None:
+                response = self.http_client.post(fees_api_url, endpoint='fees', limiter=self.rate_limiters.get('sp_api'), headers=headers, json=payload)
+                response.raise_for_status()
+                data = response.json()
+                self._cache_set('fees', 'fees/v0/products/feesEstimate', cache_params, data)
 
             fba_fee = None
             referral_fee = None
@@ -117,73 +195,196 @@ class APIIntegrator:
             fees_estimate = data.get("FeesEstimateResult", {}).get("FeesEstimate", {})
             for fee in fees_estimate.get("Fees", []):
                 if fee.get("FeeType") == "FBAFees":
-                    fba_fee = fee.get("FeeAmount")
+                    fba_fee = self._fee_amount(fee)
                 elif fee.get("FeeType") == "ReferralFee":
-                    referral_fee = fee.get("FeeAmount")
+                    referral_fee = self._fee_amount(fee)
             
             return {"fba_fee": fba_fee, "referral_fee": referral_fee}
 
         except requests.exceptions.RequestException as e:
-            click.echo(f"    Error during Amazon Product Fees API call: {e}")
+            self.instrumentation.log(f"    Error during Amazon Product Fees API call: {e}")
+            self._record_error('fees', e)
             return {"fba_fee": None, "referral_fee": None}
         # --- END AMAZON SP-API PRODUCT FEES INTEGRATION ---
 
+    @staticmethod
+    def _fee_amount(fee):
+        # FeeAmount is a MoneyType ({"CurrencyCode": "GBP", "Amount": 2.85})
+        amount = fee.get("FeeAmount")
+        if isinstance(amount, dict):
+            amount = amount.get("Amount")
+        return float(amount) if amount is not None else None
+
     def get_keepa_product_data(self, asin):
-        click.echo(f"  Integrating with Keepa API for ASIN: {asin}...")
+        self.instrumentation.log(f"  Integrating with Keepa API for ASIN: {asin}...")
         if not self.keepa_api_key:
-            click.echo("    Keepa API Key not provided. Skipping Keepa integration.")
+            self.instrumentation.log("    Keepa API Key not provided. Skipping Keepa integration.")
             return {}
 
         # The domain 'api.keepa.com' is standard. Authentication is via the 'key' query parameter.
-        keepa_api_url = f"https://api.keepa.com/product?key={self.keepa_api_key}&asin={asin}&domain=3" # Domain 3 for UK
+        keepa_api_url = f"{self.KEEPA_BASE_URL}/product?key={self.keepa_api_key}&asin={asin}&domain=3" # Domain 3 for UK
+
+        cache_params = {"asin": asin, "domain": 3}
+        product = self._cache_get('keepa', 'keepa/product', cache_params)
+        if product is not None:
+            return self._parse_keepa_product(product)
 
         try:
-            response = requests.get(keepa_api_url)
+            response = self.http_client.get(keepa_api_url, endpoint='keepa', limiter=self.rate_limiters.get('keepa'))
             response.raise_for_status()
             data = response.json()
+            self._record_keepa_tokens(data)
 
             # Parse Keepa API response
-            keepa_data = {
-                'historical_price': data.get('products', [{}])[0].get('data', {}).get('AMAZON'), # Example: Amazon price history
-                'sales_rank_history': data.get('products', [{}])[0].get('data', {}).get('SALES_RANK'),
-                'buy_box_history': data.get('products', [{}])[0].get('data', {}).get('BUY_BOX'),
-                'estimated_sales_velocity': data.get('products', [{}])[0].get('stats', {}).get('avg180', {}).get('salesRank'), # Example: 180-day average sales rank
-                'competitive_sellers': self._get_competitive_sellers_from_keepa_buybox(data.get('products', [{}])[0].get('data', {}).get('BUY_BOX')) # Extract competitive sellers
-            }
+            product = data.get('products', [{}])[0]
+            if product.get('asin'):
+                self._cache_set('keepa', 'keepa/product', cache_params, product)
+            keepa_data = self._parse_keepa_product(product)
             return keepa_data
 
         except requests.exceptions.RequestException as e:
-            click.echo(f"    Error during Keepa API call: {e}")
+            self.instrumentation.log(f"    Error during Keepa API call: {e}")
+            self._record_error('keepa', e, [asin])
             return {}
         # --- END KEEPA API INTEGRATION ---
 
-    def _get_competitive_sellers_from_keepa_buybox(self, buy_box_data, price_threshold=0.15, lookback_months=3):
-        # This is a simplified example. Real implementation would involve more robust parsing
-        # of Keepa's Buy Box history data to identify unique sellers and their prices within
-        # the specified price_threshold and lookback_months.
-        # Keepa's Buy Box data is often a list of [timestamp, price, seller_id, ...] tuples.
-        
+    def get_asins_from_barcodes(self, barcodes, domain=3):
+        # Batched variant of get_asin_from_barcode: one Keepa request per KEEPA_BATCH_SIZE codes.
+        # Returns {barcode: asin} for every barcode that resolved to a product.
+        barcodes = list(dict.fromkeys(str(barcode) for barcode in barcodes if barcode))
+        self.instrumentation.log(f"  Attempting to get ASINs for {len(barcodes)} barcodes using Keepa API...", level='info')
+        if not self.keepa_api_key:
+            self.instrumentation.log("    Keepa API Key not provided. Cannot convert barcodes to ASINs.", level='info')
+            return {}
+
+        # Barcode -> ASIN mappings are cached per code so overlapping supplier lists only
+        # send the codes that have never been resolved before.
+        asins = {}
+        for barcode in barcodes:
+            cached_asin = self._cache_get('barcode', 'keepa/product', {"code": barcode, "domain": domain})
+            if cached_asin:
+                asins[barcode] = cached_asin
+        uncached = [barcode for barcode in barcodes if barcode not in asins]
+
+        for start in range(0, len(uncached), self.KEEPA_BATCH_SIZE):
+            chunk = uncached[start:start + self.KEEPA_BATCH_SIZE]
+            keepa_api_url = f"{self.KEEPA_BASE_URL}/product?key={self.keepa_api_key}&code={','.join(chunk)}&domain={domain}"
+
+            try:
+                response = self.http_client.get(keepa_api_url, endpoint='keepa_barcode', limiter=self.rate_limiters.get('keepa'))
+                response.raise_for_status()
+                data = response.json()
+                self._record_keepa_tokens(data)
+            except requests.exceptions.RequestException as e:
+                self.instrumentation.log(f"    Error during Keepa API batch barcode-to-ASIN conversion: {e}", level='warning')
+                self._record_error('keepa_barcode', e, chunk)
+                continue
+
+            # Keepa returns one product per matched code, in no guaranteed order, so the
+            # products are matched back to the requested codes through their EAN/UPC lists.
+            pending = set(chunk)
+            for product in data.get('products') or []:
+                asin = product.get('asin')
+                if not asin:
+                    continue
+                for code in (product.get('eanList') or []) + (product.get('upcList') or []):
+                    code = str(code)
+                    if code in pending:
+                        asins[code] = asin
+                        pending.discard(code)
+            if len(chunk) == 1 and chunk[0] in pending and data.get('products'):
+                # Single-code lookups do not need the code lists to be matched back
+                asin = data['products'][0].get('asin')
+                if asin:
+                    asins[chunk[0]] = asin
+            for code in chunk:
+                if code in asins:
+                    self._cache_set('barcode', 'keepa/product', {"code": code, "domain": domain}, asins[code])
+
+        self.instrumentation.log(f"    Found ASINs for {len(asins)} of {len(barcodes)} barcodes.", level='info')
+        return asins
+
+    def get_keepa_products_data(self, asins, domain=3):
+        # Batched variant of get_keepa_product_data: one Keepa request per KEEPA_BATCH_SIZE ASINs.
+        # Returns {asin: keepa_data}; ASINs whose batch failed are left out.
+        asins = list(dict.fromkeys(asin for asin in asins if asin))
+        self.instrumentation.log(f"  Integrating with Keepa API for {len(asins)} ASINs...", level='info')
+        if not self.keepa_api_key:
+            self.instrumentation.log("    Keepa API Key not provided. Skipping Keepa integration.", level='info')
+            return {}
+
+        keepa_data = {}
+        for asin in asins:
+            product = self._cache_get('keepa', 'keepa/product', {"asin": asin, "domain": domain})
+            if product is not None:
+                keepa_data[asin] = self._parse_keepa_product(product, cached=True)
+        uncached = [asin for asin in asins if asin not in keepa_data]
+
+        for start in range(0, len(uncached), self.KEEPA_BATCH_SIZE):
+            chunk = uncached[start:start + self.KEEPA_BATCH_SIZE]
+            keepa_api_url = f"{self.KEEPA_BASE_URL}/product?key={self.keepa_api_key}&asin={','.join(chunk)}&domain={domain}"
+
+            try:
+                response = self.http_client.get(keepa_api_url, endpoint='keepa', limiter=self.rate_limiters.get('keepa'))
+                response.raise_for_status()
+                data = response.json()
+                self._record_keepa_tokens(data)
+            except requests.exceptions.RequestException as e:
+                self.instrumentation.log(f"    Error during Keepa API batch call: {e}", level='warning')
+                self._record_error('keepa', e, chunk)
+                continue
+
+            for product in data.get('products') or []:
+                if product.get('asin') in chunk:
+                    keepa_data[product['asin']] = self._parse_keepa_product(product)
+                    self._cache_set('keepa', 'keepa/product', {"asin": product['asin'], "domain": domain}, product)
+            for asin in chunk:
+                keepa_data.setdefault(asin, {}) # Keepa returned nothing for this ASIN
+
+        return keepa_data
+
+    def _parse_keepa_product(self, product, cached=False):
+        product_data = product.get('data', {})
+        if self.keepa_history is not None and product.get('asin'):
+            # A cached response was decoded and stored when it was fetched, so its stored
+            # history is reused unless the file has gone missing
+            history = self.keepa_history.load(product['asin']) if cached else None
+            if history is None:
+                history = decode_product(product_data)
+                self.keepa_history.save(product['asin'], history)
+            return {
+                'history_points': len(history),
+                'estimated_sales_velocity': product.get('stats', {}).get('avg180', {}).get('salesRank'),
+                'competitive_sellers': self._get_competitive_sellers_from_keepa_buybox(product_data.get('BUY_BOX'))
+            }
+        return {
+            'historical_price': product_data.get('AMAZON'), # Example: Amazon price history
+            'sales_rank_history': product_data.get('SALES_RANK'),
+            'buy_box_history': product_data.get('BUY_BOX'),
+            'estimated_sales_velocity': product.get('stats', {}).get('avg180', {}).get('salesRank'), # Example: 180-day average sales rank
+            'competitive_sellers': self._get_competitive_sellers_from_keepa_buybox(product_data.get('BUY_BOX')) # Extract competitive sellers
+        }
+
+    def _get_competitive_sellers_from_keepa_buybox(self, buy_box_data, price_threshold=0.15, lookback_days=90):
+        # Effective number of sellers that held the buy box within `price_threshold` of the
+        # latest buy box price over the last `lookback_days`, weighted by their time share.
+        # The batched version over many ASINs (against the SP-API buy box price) is
+        # KeepaHistoryStore.add_stats(); this covers a single product at parse time.
         if not buy_box_data:
             return 0
-
-        competitive_seller_count = 0
-        unique_sellers = set()
-        for i in range(0, len(buy_box_data), 3):
-            if i + 2 < len(buy_box_data):
-                seller_id = buy_box_data[i+2]
-                if seller_id > 0:
-                    unique_sellers.add(seller_id)
-        
-        return len(unique_sellers)
+        history = decode_product({'BUY_BOX': buy_box_data})
+        sellers = competitive_sellers([history], price_threshold=price_threshold, lookback_days=lookback_days)
+        effective = sellers['competitive_sellers'].iloc[0]
+        return 0 if np.isnan(effective) else float(effective)
 
     def get_jungle_scout_product_data(self, asin):
-        click.echo(f"  Integrating with Jungle Scout API for ASIN: {asin}...")
+        self.instrumentation.log(f"  Integrating with Jungle Scout API for ASIN: {asin}...")
         if not self.jungle_scout_api_key:
-            click.echo("    Jungle Scout API Key not provided. Skipping Jungle Scout integration.")
+            self.instrumentation.log("    Jungle Scout API Key not provided. Skipping Jungle Scout integration.")
             return {}
 
         # This uses the Product Database API as an example.
-        jungle_scout_api_url = f"https://api.junglescout.com/api/v1/products" # Common endpoint
+        jungle_scout_api_url = f"{self.JUNGLE_SCOUT_BASE_URL}/api/v1/products" # Common endpoint
         headers = {
             "Authorization": f"Bearer {self.jungle_scout_api_key}", # Common authentication method
             "Content-Type": "application/json"
@@ -191,9 +392,12 @@ class APIIntegrator:
         params = {"asin": asin} # Common parameter
 
         try:
-            response = requests.get(jungle_scout_api_url, headers=headers, params=params)
-            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-            data = response.json()
+            data = self._cache_get('jungle_scout', 'junglescout/api/v1/products', params)
+            if data is None:
+                response = self.http_client.get(jungle_scout_api_url, endpoint='jungle_scout', limiter=self.rate_limiters.get('jungle_scout'), headers=headers, params=params)
+                response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+                data = response.json()
+                self._cache_set('jungle_scout', 'junglescout/api/v1/products', params, data)
 
             # Parse Jungle Scout API response
             jungle_scout_data = {
@@ -204,6 +408,7 @@ class APIIntegrator:
             return jungle_scout_data
 
         except requests.exceptions.RequestException as e:
-            click.echo(f"    Error during Jungle Scout API call: {e}")
+            self.instrumentation.log(f"    Error during Jungle Scout API call: {e}")
+            self._record_error('jungle_scout', e)
             return {}
         # --- END JUNGLE SCOUT API INTEGRATION ---
@@ -0,0 +1,315 @@
+import time
+from collections import Counter
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from src.profit_calculator import ProfitCalculator
+from src.rate_limiter import UpstreamLimiter
+
+# Default pacing per upstream API. SP-API limits are per operation (Catalog Items
+# getCatalogItem: 2 req/s, burst 2; Product Fees: 1 req/s, burst 2), Keepa is billed
+# in tokens per minute and Jungle Scout allows a modest request rate per key.
+DEFAULT_LIMITS = {
+    'sp_api': {'rate': 2, 'burst': 2, 'max_in_flight': 4},
+    'keepa': {'rate': 5, 'burst': 5, 'max_in_flight': 4},
+    'jungle_scout': {'rate': 5, 'burst': 5, 'max_in_flight': 4},
+}
+
+ENRICHED_COLUMNS = [
+    'barcode', 'supplier_buy_price', 'vat_rate', 'asin', 'title', 'buy_box_price', 'fba_fee',
+    'referral_fee_percentage', 'estimated_monthly_sales', 'number_of_sellers', 'competitive_sellers',
+    'supplier_image_url', 'supplier_image_path', 'amazon_image_url', 'enrichment_status', 'keepa_data', 'jungle_scout_data'
+]
+
+DEFAULT_VAT_RATE = 0.20 # ProfitCalculator.score_dataframe() default for rows without a vat_rate
+
+def flatten_enriched(enriched):
+    # One output record per product from an EnrichmentEngine.enrich() result
+    row = enriched['row']
+    amazon_data = enriched['amazon_data']
+    keepa_data = enriched['keepa_data']
+    jungle_scout_data = enriched['jungle_scout_data']
+    # Pruned rows never reached Keepa or Jungle Scout: their demand is unknown, not zero
+    pruned = enriched.get('status') == 'pruned'
+
+    return {
+        'barcode': enriched['barcode'],
+        'supplier_buy_price': enriched['supplier_buy_price'],
+        'vat_rate': row.get('vat_rate'), # Optional per-product VAT rate (e.g. zero-rated goods)
+        'asin': enriched['asin'],
+        'title': amazon_data.get('title'),
+        'buy_box_price': amazon_data.get('buy_box_price'),
+        'fba_fee': amazon_data.get('fba_fee'),
+        'referral_fee_percentage': amazon_data.get('referral_fee'),
+        'estimated_monthly_sales': None if pruned else jungle_scout_data.get('estimated_monthly_sales', 0),
+        'number_of_sellers': jungle_scout_data.get('number_of_sellers'),
+        'competitive_sellers': None if pruned else keepa_data.get('competitive_sellers', 1), # Default to 1 to avoid division by zero
+        'supplier_image_url': row.get('supplier_image_url'),
+        'supplier_image_path': row.get('supplier_image_path'),
+        'amazon_image_url': amazon_data.get('main_image_url'),
+        'enrichment_status': enriched.get('status'), # ok, pruned or error (see EnrichmentEngine.enrich_outcomes)
+        'keepa_data': keepa_data, # Include raw API data for detailed report
+        'jungle_scout_data': jungle_scout_data # Include raw API data
+    }
+
+def build_enriched_frame(enriched_rows):
+    # Flattens EnrichmentEngine.enrich() results into one row per product, ready for
+    # ProfitCalculator.score_dataframe().
+    return pd.DataFrame([flatten_enriched(enriched) for enriched in enriched_rows], columns=ENRICHED_COLUMNS)
+
+def clean_value(row, column):
+    # Blank cells come through as NaN, pd.NA (string columns) or empty strings; treat all
+    # as missing. pd.isna() goes first: comparing pd.NA with '' gives pd.NA, not a bool.
+    value = row.get(column)
+    if value is None or pd.isna(value) or value == '':
+        return None
+    return value
+
+def row_key(row):
+    # Identifies a supplier row across runs: its barcode, or its ASIN when there is no barcode
+    barcode = clean_value(row, 'barcode')
+    if barcode is not None:
+        return str(barcode)
+    asin = clean_value(row, 'asin')
+    return f"asin:{asin}" if asin is not None else None
+
+def supplier_row_keys(supplier_df):
+    # One key per supplier row, unique within the sheet: row_key(), with '#2', '#3', ...
+    # appended to later rows of the same barcode (in sheet order), so duplicate rows, e.g.
+    # one product at two prices or pack sizes, keep separate journal entries. Rows with
+    # neither a barcode nor an ASIN are keyed by their position.
+    keys = []
+    seen = Counter()
+    for position, (_, row) in enumerate(supplier_df.iterrows()):
+        key = row_key(row) or f"row:{position}"
+        seen[key] += 1
+        keys.append(key if seen[key] == 1 else f"{key}#{seen[key]}")
+    return pd.Series(keys, index=supplier_df.index, dtype=object)
+
+class EnrichmentEngine:
+    def __init__(self, api_integrator, concurrency=8, limits=None, profit_calculator=None, min_roi=None, min_margin=None):
+        # min_roi and min_margin (%) are floors on a row's upper-bound profit from its
+        # catalog and fee data; rows below either are not sent to Keepa or Jungle Scout.
+        # None disables a floor.
+        self.api_integrator = api_integrator
+        self.concurrency = max(1, int(concurrency))
+        self.profit_calculator = profit_calculator or ProfitCalculator(instrumentation=api_integrator.instrumentation)
+        self.min_roi = min_roi
+        self.min_margin = min_margin
+        limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.api_integrator.rate_limiters = {
+            upstream: UpstreamLimiter(upstream, **settings) for upstream, settings in limits.items()
+        }
+
+    def enrich(self, supplier_df, on_result=None, keys=None):
+        # Returns the enriched rows that have Amazon data, in input order. on_result, if
+        # given, is called from the worker threads with every row outcome (including
+        # skipped and failed rows) as soon as that row completes. keys, one per row, are the
+        # outcomes' 'key' values; by default supplier_row_keys(supplier_df). Pass the keys
+        # computed on the whole sheet when enriching a subset of its rows.
+        outcomes = self.enrich_outcomes(supplier_df, on_result=on_result, keys=keys)
+        return [outcome for outcome in outcomes if outcome['amazon_data']]
+
+    def enrich_outcomes(self, supplier_df, on_result=None, keys=None):
+        # Like enrich(), but returns one outcome per input row with a 'status' of
+        # 'ok', 'skipped' (no ASIN or no Amazon data), 'pruned' (cannot clear the profit
+        # floors, so Keepa and Jungle Scout were never called) or 'error' (an API call
+        # failed, see 'errors'). Outputs are in input order; on_result sees the rows that
+        # survive pruning in descending order of estimated margin.
+        rows = [row for _, row in supplier_df.iterrows()]
+        keys = list(supplier_row_keys(supplier_df) if keys is None else keys)
+        instrumentation = self.api_integrator.instrumentation
+        row_seconds = [0.0] * len(rows)
+
+        def finish(index, outcome):
+            instrumentation.record_row(row_seconds[index])
+            instrumentation.count(f"rows_{outcome['status']}")
+            if on_result is not None:
+                on_result(outcome)
+            return outcome
+
+        # Pass 1: resolve every missing ASIN with batched Keepa barcode lookups.
+        barcodes = [str(clean_value(row, 'barcode')) for row in rows
+                    if not clean_value(row, 'asin') and clean_value(row, 'barcode')]
+        with instrumentation.stage('barcode_lookup'):
+            barcode_to_asin, failed_barcodes = self._batched(self.api_integrator.get_asins_from_barcodes, barcodes)
+        asins = [self._resolve_asin(row, barcode_to_asin) for row in rows]
+
+        # Pass 2: SP-API catalog and fees for every row, run concurrently on a bounded
+        # thread pool. executor.map yields results in submission order, so outcomes stay
+        # aligned with the input rows regardless of which calls finish first.
+        def start(index):
+            started = time.perf_counter()
+            outcome = self.start_row(rows[index], asins[index], failed_barcodes, key=keys[index])
+            row_seconds[index] += time.perf_counter() - started
+            return outcome
+
+        with instrumentation.stage('amazon_lookup'):
+            outcomes = self._map(start, range(len(rows)))
+
+        # Pass 3: cheap upper-bound profit from the catalog and fee data. Rows that cannot
+        # clear the floors are finished here; the rest continue, best margin first.
+        candidates = [index for index, outcome in enumerate(outcomes) if outcome['status'] == 'ok']
+        margin, pruned = self.upper_bound(outcomes, candidates)
+        for index, is_pruned in zip(candidates, pruned):
+            if is_pruned:
+                outcomes[index]['status'] = 'pruned'
+        for index, outcome in enumerate(outcomes):
+            if outcome['status'] != 'ok':
+                finish(index, outcome)
+        kept = np.flatnonzero(~pruned)
+        order = kept[np.argsort(-np.nan_to_num(margin[kept], nan=-np.inf), kind='stable')] # NaN margins (missing fees) last
+        survivors = [candidates[position] for position in order]
+        if candidates:
+            instrumentation.log(f"  Pruned {int(pruned.sum())} of {len(candidates)} rows below the profit floors before Keepa and Jungle Scout.", level='info')
+
+        # Pass 4: Keepa product data for the surviving ASINs, 100 per request, best first.
+        with instrumentation.stage('keepa_products'):
+            keepa_by_asin, failed_asins = self._batched(self.api_integrator.get_keepa_products_data, [asins[index] for index in survivors])
+
+        # Pass 5: per-row Jungle Scout calls for the survivors, submitted best first.
+        def complete(index):
+            started = time.perf_counter()
+            outcome = self.complete_row(outcomes[index], keepa_by_asin, failed_asins)
+            row_seconds[index] += time.perf_counter() - started
+            return finish(index, outcome)
+
+        with instrumentation.stage('row_enrichment'):
+            self._map(complete, survivors)
+        return outcomes
+
+    def upper_bound(self, outcomes, indexes):
+        # Optimistic profit margin (%) per outcome, and whether it falls below the floors.
+        # Rows without a buy box price or fees get a NaN margin and are never pruned.
+        amazon_data = [outcomes[index]['amazon_data'] for index in indexes]
+        return self._upper_bound(
+            [data.get('buy_box_price') for data in amazon_data],
+            [data.get('fba_fee') for data in amazon_data],
+            [data.get('referral_fee') for data in amazon_data],
+            [outcomes[index]['supplier_buy_price'] for index in indexes],
+            [clean_value(outcomes[index]['row'], 'vat_rate') for index in indexes]
+        )
+
+    def still_pruned(self, entries):
+        # Keys of journalled 'pruned' entries (src/run_journal.py) that the current floors
+        # would prune again, judged from their recorded catalog and fee data. Rows pruned
+        # under other floors, or with pruning now disabled, are left out and get enriched.
+        entries = [entry for entry in entries.values() if entry['status'] == 'pruned' and entry['record']]
+        records = [entry['record'] for entry in entries]
+        _, pruned = self._upper_bound(
+            [record.get('buy_box_price') for record in records],
+            [record.get('fba_fee') for record in records],
+            [record.get('referral_fee_percentage') for record in records],
+            [record.get('supplier_buy_price') for record in records],
+            [record.get('vat_rate') for record in records]
+        )
+        return {entry['key'] for entry, is_pruned in zip(entries, pruned) if is_pruned}
+
+    def _upper_bound(self, buy_box_price, fba_fee, referral_fee, supplier_buy_price, vat_rate):
+        # VAT scales the pre-VAT margin toward zero, so leaving it out raises a profit and
+        # charging the row's full rate raises a loss. The larger of the two is never below
+        # the scored profit, so a pruned row could not have cleared the floors, negative
+        # floors included.
+        vat_rate = pd.to_numeric(pd.Series(vat_rate, dtype=object), errors='coerce').fillna(DEFAULT_VAT_RATE).to_numpy(dtype=float)
+        profit = np.maximum(
+            self.profit_calculator.profit_array(buy_box_price, fba_fee, referral_fee, supplier_buy_price, vat_rate=0.0),
+            self.profit_calculator.profit_array(buy_box_price, fba_fee, referral_fee, supplier_buy_price, vat_rate=vat_rate)
+        )
+        margin = self.profit_calculator.profit_percentage_array(profit, buy_box_price)
+        roi = self.profit_calculator.roi_array(profit, supplier_buy_price)
+        pruned = np.zeros(len(profit), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            if self.min_margin is not None:
+                pruned |= margin < self.min_margin
+            if self.min_roi is not None:
+                pruned |= roi < self.min_roi
+        return margin, pruned
+
+    def start_row(self, row, asin, failed_barcodes=(), key=None):
+        # SP-API catalog and fees. 'status' is 'ok' when there is Amazon data to continue with.
+        barcode = row['barcode'] # Assuming a 'barcode' column in supplier data
+        supplier_buy_price = row['buy_price'] # Assuming a 'buy_price' column
+        outcome = {
+            'row': row,
+            'key': row_key(row) if key is None else key,
+            'barcode': barcode,
+            'supplier_buy_price': supplier_buy_price,
+            'asin': asin,
+            'amazon_data': {},
+            'keepa_data': {}, # Fetched in batches in enrich_outcomes()
+            'jungle_scout_data': {},
+            'status': 'ok',
+            'errors': [],
+        }
+        if str(barcode) in failed_barcodes:
+            outcome['errors'].append({'endpoint': 'keepa_barcode', 'error': 'Batch barcode lookup failed', 'keys': [str(barcode)]})
+
+        log = self.api_integrator.instrumentation.log
+        log(f"Processing product with barcode: {barcode}")
+
+        with self.api_integrator.track_errors() as errors:
+            if not asin:
+                log(f"  Skipping {barcode}: ASIN not found or derivable.")
+            else:
+                # 1. Amazon API Integration
+                outcome['amazon_data'] = self.api_integrator.get_amazon_product_data(asin)
+                if not outcome['amazon_data']:
+                    log(f"  Skipping {barcode}: Could not get Amazon data.")
+
+        outcome['errors'].extend(errors)
+        return self._set_status(outcome)
+
+    def complete_row(self, outcome, keepa_by_asin, failed_asins=()):
+        # Keepa (already fetched in batches) and Jungle Scout for a row start_row() left 'ok'
+        asin = outcome['asin']
+        outcome['keepa_data'] = keepa_by_asin.get(asin, {})
+        if asin in failed_asins:
+            outcome['errors'].append({'endpoint': 'keepa', 'error': 'Batch product lookup failed', 'keys': [asin]})
+
+        with self.api_integrator.track_errors() as errors:
+            # 2. Jungle Scout API Integration
+            outcome['jungle_scout_data'] = self.api_integrator.get_jungle_scout_product_data(asin)
+
+        outcome['errors'].extend(errors)
+        return self._set_status(outcome)
+
+    def _set_status(self, outcome):
+        if outcome['errors']:
+            outcome['status'] = 'error'
+            self.api_integrator.instrumentation.log(f"  {outcome['barcode']}: {len(outcome['errors'])} API error(s), e.g. {outcome['errors'][0]['error']}")
+        elif not outcome['amazon_data']:
+            outcome['status'] = 'skipped'
+        return outcome
+
+    def _resolve_asin(self, row, barcode_to_asin):
+        # If ASIN is not directly available, use the one converted from the barcode by Keepa
+        asin = clean_value(row, 'asin')
+        if not asin and clean_value(row, 'barcode'):
+            asin = barcode_to_asin.get(str(clean_value(row, 'barcode')))
+        return asin
+
+    def _batched(self, fetch, keys):
+        # Splits keys into Keepa-sized batches, fetches the batches concurrently and
+        # merges the per-batch {key: value} results. Also returns the keys whose batch
+        # failed, so those rows can be reported as errors rather than "not found".
+        keys = list(dict.fromkeys(keys))
+        batch_size = self.api_integrator.KEEPA_BATCH_SIZE
+        batches = [keys[start:start + batch_size] for start in range(0, len(keys), batch_size)]
+
+        def fetch_batch(batch):
+            with self.api_integrator.track_errors() as errors:
+                result = fetch(batch)
+            return result, {key for error in errors for key in error['keys']}
+
+        merged = {}
+        failed = set()
+        for result, failed_keys in self._map(fetch_batch, batches):
+            merged.update(result)
+            failed.update(failed_keys)
+        return merged, failed
+
+    def _map(self, func, items):
+        if self.concurrency == 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(func, items))
@@ -0,0 +1,136 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+class RetryPolicy:
+    # Jittered exponential backoff ("full jitter": a random wait between 0 and
+    # backoff_base * 2 ** attempt, capped at backoff_max). Server hints take precedence:
+    # Retry-After (seconds or an HTTP date) is honoured as-is, and on SP-API throttling
+    # the x-amzn-RateLimit-Limit header (requests per second) sets the minimum wait.
+    def __init__(self, max_retries=5, backoff_base=0.5, backoff_max=60.0, statuses=RETRY_STATUSES):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.statuses = frozenset(statuses)
+
+    def should_retry(self, attempt, response=None):
+        if attempt >= self.max_retries:
+            return False
+        return response is None or response.status_code in self.statuses
+
+    def delay(self, attempt, response=None):
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if response is None:
+            return backoff
+
+        retry_after = self._parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        rate_limit = response.headers.get('x-amzn-RateLimit-Limit')
+        if response.status_code == 429 and rate_limit:
+            try:
+                return min(max(backoff, 1.0 / float(rate_limit)), self.backoff_max)
+            except (ValueError, ZeroDivisionError):
+                pass
+        return backoff
+
+    @staticmethod
+    def _parse_retry_after(value):
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class HTTPClient:
+    # Keeps one requests.Session per host so TLS connections are reused across calls and
+    # threads, and retries throttled (429), failed (5xx) and dropped requests according
+    # to the RetryPolicy. `timeout` is passed to requests as (connect, read) seconds.
+    # With an Instrumentation (src/instrumentation.py), every attempt's latency, status and
+    # retry flag is recorded under the `endpoint` name given to request().
+    def __init__(self, timeout=(5.0, 30.0), retry_policy=None, pool_maxsize=32, instrumentation=None):
+        self.timeout = timeout
+        self.instrumentation = instrumentation
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        parsed = urlparse(url)
+        host = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount(host, adapter)
+                self._sessions[host] = session
+        return session
+
+    def request(self, method, url, limiter=None, endpoint=None, **kwargs):
+        # Sends the request through `limiter` (an UpstreamLimiter) on every attempt, so
+        # retries are paced like any other call. Returns the final response; callers are
+        # expected to call raise_for_status() on it.
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session(url)
+        attempt = 0
+        endpoint = endpoint or urlparse(url).netloc
+        while True:
+            try:
+                if limiter is not None:
+                    with limiter:
+                        response = self._send(session, method, url, endpoint, attempt, kwargs)
+                else:
+                    response = self._send(session, method, url, endpoint, attempt, kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not self.retry_policy.should_retry(attempt):
+                    raise
+                time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+
+            if not self.retry_policy.should_retry(attempt, response):
+                return response
+            time.sleep(self.retry_policy.delay(attempt, response))
+            response.close()
+            attempt += 1
+
+    def _send(self, session, method, url, endpoint, attempt, kwargs):
+        # Latency is measured inside the limiter, so time spent waiting for a token is not counted
+        if self.instrumentation is None:
+            return session.request(method, url, **kwargs)
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.instrumentation.record_request(endpoint, time.perf_counter() - started, None, retry=attempt > 0)
+            raise
+        self.instrumentation.record_request(endpoint, time.perf_counter() - started, response.status_code, retry=attempt > 0)
+        return response
+
+    def get(self, url, limiter=None, endpoint=None, **kwargs):
+        return self.request('GET', url, limiter=limiter, endpoint=endpoint, **kwargs)
+
+    def post(self, url, limiter=None, endpoint=None, **kwargs):
+        return self.request('POST', url, limiter=limiter, endpoint=endpoint, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
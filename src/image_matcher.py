@@ -1,58 +1,199 @@
-import click
 import cv2
+import numpy as np
 import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from src.instrumentation import Instrumentation
+
+# Two-stage matching:
+#   1. Perceptual hashes (64-bit pHash + dHash) settle the clear cases cheaply: near
+#      identical images are matches, very different ones are mismatches.
+#   2. Only the ambiguous pairs in between get ORB keypoint matching with Lowe's ratio
+#      test and a RANSAC homography, spread across a process pool.
+# Images are converted to grayscale and downscaled so their longest side is at most
+# MAX_SIDE pixels; both stages work on that array. Stage 1 keeps only the hashes, and
+# arrays are loaded for the ambiguous pairs ORB_BATCH_SIZE pairs at a time, so memory is
+# bounded by that batch rather than by the number of pairs.
+
+MAX_SIDE = 400
+ORB_FEATURES = 500
+RATIO_TEST = 0.75
+MIN_GOOD_MATCHES = 10
+INLIER_TARGET = 40 # RANSAC inliers that count as a certain match (similarity 1.0)
+BATCH_SIZE = 2000 # Pairs hashed per batch
+ORB_BATCH_SIZE = 200 # Ambiguous pairs whose arrays are held in memory at once (about 64MB at MAX_SIDE)
+
+def _orb_similarity(pair):
+    # Module-level so it can run in worker processes (cv2 objects cannot be pickled)
+    image_a, image_b = pair
+    orb = cv2.ORB_create(nfeatures=ORB_FEATURES)
+    keypoints_a, descriptors_a = orb.detectAndCompute(image_a, None)
+    keypoints_b, descriptors_b = orb.detectAndCompute(image_b, None)
+    if descriptors_a is None or descriptors_b is None or len(keypoints_a) < 2 or len(keypoints_b) < 2:
+        return 0.0
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    good = [
+        candidates[0] for candidates in matcher.knnMatch(descriptors_a, descriptors_b, k=2)
+        if len(candidates) == 2 and candidates[0].distance < RATIO_TEST * candidates[1].distance
+    ]
+    if len(good) < MIN_GOOD_MATCHES:
+        return 0.0
+
+    points_a = np.float32([keypoints_a[match.queryIdx].pt for match in good]).reshape(-1, 1, 2)
+    points_b = np.float32([keypoints_b[match.trainIdx].pt for match in good]).reshape(-1, 1, 2)
+    _, inlier_mask = cv2.findHomography(points_a, points_b, cv2.RANSAC, 5.0)
+    if inlier_mask is None:
+        return 0.0
+    return min(1.0, float(inlier_mask.sum()) / INLIER_TARGET)
+
+def downscale_image(image):
+    # Longest side at most MAX_SIDE pixels; smaller images are left as they are
+    height, width = image.shape[:2]
+    scale = MAX_SIDE / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+def perceptual_hashes(image):
+    # pHash: sign of the low-frequency 8x8 DCT coefficients against their median.
+    # dHash: sign of horizontal gradients on a 9x8 thumbnail.
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(small)[:8, :8].flatten()
+    phash = np.packbits(low_frequencies > np.median(low_frequencies[1:]))
+    thumbnail = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    dhash = np.packbits((thumbnail[:, 1:] > thumbnail[:, :-1]).flatten())
+    return np.concatenate([phash, dhash]) # 16 bytes: pHash then dHash
 
 class ImageMatcher:
+    def __init__(self, match_threshold=0.5, hash_match_distance=8, hash_mismatch_distance=24, workers=None, image_store=None, instrumentation=None):
+        # Hash distances are Hamming distances out of 64 bits, averaged over pHash and dHash.
+        # With an ImageStore (src/image_store.py), images may be URLs or paths and are read
+        # from the store's pre-computed arrays and hashes instead of being decoded again.
+        self.image_store = image_store
+        self.instrumentation = instrumentation or Instrumentation()
+        self.match_threshold = match_threshold
+        self.hash_match_distance = hash_match_distance
+        self.hash_mismatch_distance = hash_mismatch_distance
+        self.workers = workers or os.cpu_count() or 1
+        self._process_pool = None # Started on first use and reused for every batch; see close()
+
     def match_product_image(self, image_path_supplier, image_path_amazon):
-        click.echo(f"  Matching images using OpenCV: {image_path_supplier} vs {image_path_amazon}...")
-        # --- ACTUAL IMAGE MATCHING IMPLEMENTATION ---
-        # In a real scenario, you would load images using cv2.imread() and compare them.
-        # This could involve:
-        # 1. Image preprocessing (resizing, grayscale conversion).
-        # 2. Feature extraction (e.g., SIFT, SURF, ORB).
-        # 3. Feature matching and homography estimation.
-        # 4. Perceptual hashing for quick similarity checks.
-        #
-        # Example (conceptual, requires actual image loading and comparison logic):
-        # img1 = cv2.imread(image_path_supplier)
-        # img2 = cv2.imread(image_path_amazon)
-        # if img1 is None or img2 is None:
-        #     click.echo("    Error: Could not load one or both images.")
-        #     return False
-        #
-        # # Implement your image comparison logic here
-        # similarity_score = self._compare_images(img1, img2) # Your custom comparison method
-        #
-        # if similarity_score > THRESHOLD: # Define a suitable THRESHOLD
-        #     click.echo("    Image match confirmed.")
-        #     return True
-        # else:
-        #     click.echo("    Image match not confirmed.")
-        #     return False
-        
-        click.echo("    Image matching logic needs to be implemented.")
-        return False # Default to False until implemented
+        log = self.instrumentation.log
+        log(f"  Matching images using OpenCV: {image_path_supplier} vs {image_path_amazon}...")
+        similarity = self.compare_pairs([(image_path_supplier, image_path_amazon)])[0]
+        if np.isnan(similarity):
+            log("    Error: Could not load one or both images.")
+            return False
+        if similarity >= self.match_threshold:
+            log("    Image match confirmed.")
+            return True
+        log("    Image match not confirmed.")
+        return False
 
     def _compare_images(self, img1, img2):
-        # This is a placeholder for your actual image comparison logic.
-        # You might use methods like:
-        # - cv2.matchTemplate
-        # - Feature matching with BFMatcher or FLANN
-        # - Perceptual hashing libraries
-        return 0.0 # Return a similarity score (e.g., between 0 and 1)
-
-    def reduce_false_positives(self, data_frame):
-        click.echo("  Applying OpenCV image matching to reduce false positives...")
-        # This function would iterate through a DataFrame of potential matches
-        # and use image_path_supplier and image_path_amazon columns to call match_product_image
-        # and then filter out rows that don't match.
-        #
-        # Example (conceptual, requires actual image paths in data_frame):
-        # filtered_df = data_frame[data_frame.apply(lambda row: self.match_product_image(
-        #     row['supplier_image_path'], row['amazon_image_path']), axis=1)]
-        #
-        # click.echo(f"    Reduced potential matches from {len(data_frame)} to {len(filtered_df)}.")
-        # return filtered_df
-        
-        click.echo("    False positive reduction logic needs to be implemented.")
-        return data_frame # Return original DataFrame until implemented
\ No newline at end of file
+        # Similarity score between 0 and 1 for two images already loaded with load_image()
+        return _orb_similarity((img1, img2))
+
+    def load_image(self, image_path):
+        if self.image_store is not None:
+            return self.image_store.load_array(image_path)
+        if not isinstance(image_path, str) or not image_path or not os.path.exists(image_path):
+            return None
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None
+        return downscale_image(image)
+
+    def perceptual_hashes(self, image):
+        return perceptual_hashes(image)
+
+    def image_hashes(self, image_path):
+        # Perceptual hashes of one image, or None; the decoded array is not kept
+        if self.image_store is not None:
+            return self.image_store.get_hashes(image_path)
+        image = self.load_image(image_path)
+        return None if image is None else perceptual_hashes(image)
+
+    def compare_pairs(self, pairs):
+        # Returns one similarity score (0..1) per (supplier image, Amazon image) pair, NaN
+        # where either image cannot be loaded. Pairs are processed in batches of BATCH_SIZE.
+        scores = np.full(len(pairs), np.nan)
+        hashes = {} # Hashes are tiny, so they are kept for the whole call (None: image unavailable)
+        for start in range(0, len(pairs), BATCH_SIZE):
+            batch = pairs[start:start + BATCH_SIZE]
+            scores[start:start + len(batch)] = self._compare_batch(batch, hashes)
+        return scores
+
+    def _compare_batch(self, pairs, hashes):
+        paths = [path for path in dict.fromkeys(path for pair in pairs for path in pair if isinstance(path, str) and path)
+                 if path not in hashes]
+        # Stage 1 only needs hashes: read from the store, or decoded and hashed one image at
+        # a time (cv2 releases the GIL while decoding)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            hashes.update(zip(paths, executor.map(self.image_hashes, paths)))
+
+        scores = np.full(len(pairs), np.nan)
+        ambiguous = []
+        for index, (supplier_path, amazon_path) in enumerate(pairs):
+            if hashes.get(supplier_path) is None or hashes.get(amazon_path) is None:
+                continue
+            distance = np.unpackbits(hashes[supplier_path] ^ hashes[amazon_path]).sum() / 2
+            # Stage 1 scores stay on the same 0..1 scale as ORB: clear matches land near 1,
+            # clear mismatches are scaled below match_threshold.
+            if distance <= self.hash_match_distance:
+                scores[index] = 1 - distance / 64
+            elif distance >= self.hash_mismatch_distance:
+                scores[index] = (1 - distance / 64) * self.match_threshold
+            else:
+                ambiguous.append(index)
+
+        for start in range(0, len(ambiguous), ORB_BATCH_SIZE):
+            indexes = ambiguous[start:start + ORB_BATCH_SIZE]
+            scores[indexes] = self._orb_scores([pairs[index] for index in indexes])
+        return scores
+
+    def _orb_scores(self, pairs):
+        # Stage 2 for a batch of ambiguous pairs: load their arrays, then score on the pool
+        paths = list(dict.fromkeys(path for pair in pairs for path in pair))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            images = dict(zip(paths, executor.map(self.load_image, paths)))
+        scores = np.full(len(pairs), np.nan)
+        loaded = [index for index, (supplier_path, amazon_path) in enumerate(pairs)
+                  if images[supplier_path] is not None and images[amazon_path] is not None]
+        jobs = [(images[pairs[index][0]], images[pairs[index][1]]) for index in loaded]
+        if len(jobs) < 4 or self.workers == 1:
+            scores[loaded] = [_orb_similarity(job) for job in jobs]
+        else:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.workers)
+            scores[loaded] = list(self._process_pool.map(_orb_similarity, jobs, chunksize=max(1, len(jobs) // (self.workers * 4))))
+        return scores
+
+    def close(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
+
+    def reduce_false_positives(self, data_frame, supplier_column='supplier_image_path', amazon_column='amazon_image_url'):
+        self.instrumentation.log("  Applying OpenCV image matching to reduce false positives...", level='info')
+        # Adds an image_similarity score per row and drops rows whose images were compared
+        # and did not match. Rows without comparable images are kept (is_image_matched is
+        # left empty) so a missing image never discards a product on its own.
+        if supplier_column not in data_frame or amazon_column not in data_frame:
+            self.instrumentation.log("    Image columns not found; skipping image matching.", level='info')
+            return data_frame
+
+        pairs = list(zip(data_frame[supplier_column], data_frame[amazon_column]))
+        similarity = self.compare_pairs(pairs)
+        data_frame = data_frame.copy()
+        data_frame['image_similarity'] = np.round(similarity, 3)
+        data_frame['is_image_matched'] = pd.array(
+            [None if np.isnan(score) else bool(score >= self.match_threshold) for score in similarity], dtype='boolean'
+        )
+
+        filtered_df = data_frame[data_frame['is_image_matched'].fillna(True).astype(bool)]
+        self.instrumentation.count('image_mismatches_dropped', len(data_frame) - len(filtered_df))
+        self.instrumentation.log(f"    Reduced potential matches from {len(data_frame)} to {len(filtered_df)}.", level='info')
+        return filtered_df
+
@@ -0,0 +1,183 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from src.http_client import HTTPClient
+from src.image_matcher import downscale_image, perceptual_hashes
+
+DEFAULT_IMAGE_DIR = os.path.join('.cache', 'wholesalefba', 'images')
+
+class ImageStore:
+    # Local content-addressed image cache. Originals are stored under their SHA-256 digest
+    # in <store_dir>/objects/<2 hex chars>/<digest>, next to <digest>.gray.npy, the
+    # grayscale array downscaled for matching. A small SQLite index maps each source (URL
+    # or local path) to its digest and keeps the perceptual hashes per digest, so the same
+    # image behind several URLs is stored, decoded and hashed once, and later runs read
+    # hashes and arrays without touching the network or the JPEG decoder. Local files are
+    # indexed by path, modification time and size, so a file replaced at the same path is
+    # read and hashed again.
+    #
+    # prefetch() queues downloads on a background thread pool; lookups for a source that
+    # is still being fetched wait for that download instead of starting another one.
+    def __init__(self, store_dir=DEFAULT_IMAGE_DIR, http_client=None, workers=8):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.http_client = http_client or HTTPClient()
+        self.hits = 0
+        self.misses = 0
+        self._failed = set() # Sources that could not be fetched or decoded during this run
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-prefetch')
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(store_dir, 'index.sqlite3'), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, digest TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            " digest TEXT PRIMARY KEY, hashes BLOB NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL)"
+        )
+        self._connection.commit()
+
+    def prefetch(self, sources):
+        # Queues every source that is not stored yet; returns immediately
+        for source in sources:
+            if not isinstance(source, str) or not source:
+                continue
+            key = self._source_key(source)
+            with self._lock:
+                if key in self._pending or key in self._failed:
+                    continue
+                if self._lookup(key) is not None:
+                    continue
+                self._pending[key] = self._executor.submit(self._ingest, source, key)
+
+    def get_hashes(self, source):
+        # Perceptual hashes (16 bytes, see image_matcher.perceptual_hashes) or None
+        entry = self._resolve(source)
+        return None if entry is None else np.frombuffer(entry[1], dtype=np.uint8)
+
+    def load_array(self, source):
+        # Downscaled grayscale array or None
+        entry = self._resolve(source)
+        if entry is None:
+            return None
+        try:
+            return np.load(self._object_path(entry[0]) + '.gray.npy')
+        except (OSError, ValueError):
+            return None
+
+    def _resolve(self, source):
+        # (digest, hashes) for a source, fetching it now if it was never stored
+        if not isinstance(source, str) or not source:
+            return None
+        key = self._source_key(source)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if key in self._failed:
+                return None
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = self._executor.submit(self._ingest, source, key)
+        return future.result()
+
+    @staticmethod
+    def _source_key(source):
+        # URLs as they are; local files as path|mtime|size, or just the path if missing
+        if source.startswith(('http://', 'https://')):
+            return source
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return source
+        return f"{source}|{stat.st_mtime_ns}|{stat.st_size}"
+
+    def _lookup(self, key):
+        # Expects self._lock to be held
+        return self._connection.execute(
+            "SELECT objects.digest, objects.hashes FROM sources JOIN objects ON objects.digest = sources.digest"
+            " WHERE sources.source = ?", (key,)
+        ).fetchone()
+
+    def _ingest(self, source, key):
+        try:
+            data = self._read_source(source)
+            entry = self._store(key, data) if data else None
+        except Exception:
+            entry = None # Unreachable or undecodable images are treated like missing ones
+        with self._lock:
+            self._pending.pop(key, None)
+            if entry is None:
+                self._failed.add(key)
+        return entry
+
+    def _read_source(self, source):
+        if source.startswith(('http://', 'https://')):
+            response = self.http_client.get(source, endpoint='image')
+            response.raise_for_status()
+            return response.content
+        if not os.path.exists(source):
+            return None
+        with open(source, 'rb') as handle:
+            return handle.read()
+
+    def _store(self, key, data):
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            row = self._connection.execute("SELECT hashes FROM objects WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                return None
+            array = downscale_image(image)
+            object_path = self._object_path(digest)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            # Written to per-thread temporary names and renamed, so neither a crash nor two
+            # sources with the same content downloaded at once can leave a torn object
+            temporary_suffix = f'.{threading.get_ident()}.tmp'
+            with open(object_path + temporary_suffix, 'wb') as handle:
+                handle.write(data)
+            os.replace(object_path + temporary_suffix, object_path)
+            with open(object_path + '.gray.npy' + temporary_suffix, 'wb') as handle:
+                np.save(handle, array)
+            os.replace(object_path + '.gray.npy' + temporary_suffix, object_path + '.gray.npy')
+            hashes = perceptual_hashes(array).tobytes()
+            height, width = image.shape[:2]
+        else:
+            hashes = row[0]
+            width = height = None
+        with self._lock:
+            if width is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO objects (digest, hashes, width, height) VALUES (?, ?, ?, ?)",
+                    (digest, hashes, width, height),
+                )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sources (source, digest, fetched_at) VALUES (?, ?, ?)",
+                (key, digest, time.time()),
+            )
+            self._connection.commit()
+        return digest, hashes
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'failed': len(self._failed)}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,101 @@
+import hashlib
+import time
+
+import numpy as np
+import pandas as pd
+from src.enrichment_engine import ENRICHED_COLUMNS, clean_value
+from src.profit_calculator import ProfitCalculator
+from src.run_journal import COMPLETED_STATUSES
+
+# Incremental runs: suppliers resend near-identical price lists, so a row whose barcode,
+# buy price and pack size are unchanged since the previous run can reuse that run's
+# journalled result (src/run_journal.py) instead of calling the APIs again, as long as
+# its market data is younger than the staleness bound. Only new, changed and stale rows
+# are enriched. change_report() then compares the previous and current results.
+
+FINGERPRINT_COLUMNS = ('barcode', 'buy_price', 'pack_size')
+DEFAULT_MAX_AGE_DAYS = 14
+CHANGE_TYPES = ('new', 'removed', 'price_changed', 'margin_flipped')
+PRICE_TOLERANCE = 0.005 # Supplier prices are compared to the penny
+
+CHANGE_COLUMNS = [
+    'change', 'barcode', 'asin', 'title',
+    'previous_supplier_buy_price', 'supplier_buy_price',
+    'previous_profit', 'profit', 'previous_profit_percentage', 'profit_percentage', 'previous_roi', 'roi',
+]
+
+def row_fingerprint(row):
+    # Stable digest of the supplier fields that decide whether a stored result still applies.
+    # Prices are normalised so 5, 5.0 and "5.00" fingerprint alike.
+    parts = []
+    for column in FINGERPRINT_COLUMNS:
+        value = clean_value(row, column)
+        if value is not None and column != 'barcode':
+            try:
+                value = f"{float(value):.4f}"
+            except (TypeError, ValueError):
+                pass
+        parts.append('' if value is None else str(value))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+def reusable_entries(previous_entries, row_keys, fingerprints, max_age_days=DEFAULT_MAX_AGE_DAYS, now=None, pruned_keys=()):
+    # {key: previous journal entry} for the rows whose result can be carried over: same
+    # fingerprint, completed without API errors (pruned rows only when their key is in
+    # pruned_keys, i.e. the current floors still prune them), and market data fetched
+    # within max_age_days
+    oldest = (time.time() if now is None else now) - max_age_days * 86400
+    reusable = {}
+    for key, fingerprint in zip(row_keys, fingerprints):
+        entry = previous_entries.get(key)
+        if entry is None or entry.get('fingerprint') != fingerprint:
+            continue
+        if entry['status'] not in COMPLETED_STATUSES and not (entry['status'] == 'pruned' and key in pruned_keys):
+            continue
+        if entry.get('fetched_at', entry['recorded_at']) >= oldest:
+            reusable[key] = entry
+    return reusable
+
+def records_frame(entries, keys=None):
+    # Enriched records of the journal entries that have one, indexed by row key
+    keys = entries.keys() if keys is None else keys
+    keyed = [(key, entries[key]['record']) for key in keys if key in entries and entries[key]['record']]
+    return pd.DataFrame([record for _, record in keyed], columns=ENRICHED_COLUMNS,
+                        index=pd.Index([key for key, _ in keyed], name='key'))
+
+def change_report(previous_df, current_df, margin_threshold=0.0, profit_calculator=None):
+    # One row per product and change, between two scored result frames indexed by row key:
+    #   new             in the current results only
+    #   removed         in the previous results only
+    #   price_changed   the supplier buy price moved
+    #   margin_flipped  profit_percentage crossed `margin_threshold` (%) in either direction
+    # Frames without profit columns (e.g. journal records) are scored first.
+    profit_calculator = profit_calculator or ProfitCalculator()
+    previous_df = _scored(previous_df, profit_calculator)
+    current_df = _scored(current_df, profit_calculator)
+
+    columns = ['barcode', 'asin', 'title', 'supplier_buy_price', 'profit', 'profit_percentage', 'roi']
+    merged = current_df[columns].join(previous_df[columns].add_prefix('previous_'), how='outer')
+    in_current = merged.index.isin(current_df.index)
+    in_previous = merged.index.isin(previous_df.index)
+    for column in ('barcode', 'asin', 'title'):
+        merged[column] = merged[column].where(in_current, merged[f'previous_{column}'])
+
+    current_price = pd.to_numeric(merged['supplier_buy_price'], errors='coerce').to_numpy(dtype=float)
+    previous_price = pd.to_numeric(merged['previous_supplier_buy_price'], errors='coerce').to_numpy(dtype=float)
+    current_margin = pd.to_numeric(merged['profit_percentage'], errors='coerce').to_numpy(dtype=float)
+    previous_margin = pd.to_numeric(merged['previous_profit_percentage'], errors='coerce').to_numpy(dtype=float)
+    both = in_current & in_previous
+    with np.errstate(invalid='ignore'):
+        price_changed = both & (np.abs(current_price - previous_price) > PRICE_TOLERANCE)
+        margin_flipped = both & ~np.isnan(current_margin) & ~np.isnan(previous_margin) & (
+            (current_margin > margin_threshold) != (previous_margin > margin_threshold))
+
+    masks = {'new': in_current & ~in_previous, 'removed': in_previous & ~in_current,
+             'price_changed': price_changed, 'margin_flipped': margin_flipped}
+    parts = [merged[masks[change]].assign(change=change) for change in CHANGE_TYPES]
+    return pd.concat(parts)[CHANGE_COLUMNS]
+
+def _scored(data_frame, profit_calculator):
+    if 'profit' in data_frame:
+        return data_frame
+    return profit_calculator.score_dataframe(data_frame)
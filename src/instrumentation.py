@@ -0,0 +1,260 @@
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import click
+import numpy as np
+
+# Log modes:
+#   verbose  every message, including one or more lines per row and API call
+#   quiet    only run-level messages (stages, chunks, summaries); per-row detail is dropped
+#            (the default)
+#   json     run-level messages as one JSON object per line on stderr
+LOG_MODES = ('verbose', 'quiet', 'json')
+
+# Upper bounds (seconds) of the latency histogram buckets in the Prometheus output
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Log-spaced bucket bounds (seconds) the latency percentiles are read from: 100µs to
+# 10,000s in steps of under 5%, so a percentile is within about 2.5% of the exact value
+PERCENTILE_BUCKETS = tuple(np.geomspace(1e-4, 1e4, 401).tolist())
+
+METRIC_PREFIX = 'wholesalefba'
+
+class Instrumentation:
+    # Collects run metrics from every component of a run and replaces their per-row
+    # click.echo output with levelled logging. One instance is shared by the HTTP client,
+    # APIIntegrator, EnrichmentEngine, ProfitCalculator, ImageMatcher and ReportGenerator;
+    # all methods are thread-safe.
+    #
+    #   stage(name)             wall time of a pipeline stage (context manager, accumulates)
+    #   record_request(...)     one HTTP attempt: latency, status, whether it was a retry
+    #   record_error(endpoint)  an API call that failed after retries
+    #   record_keepa_tokens()   Keepa tokensConsumed / tokensLeft from a response
+    #   record_row(seconds)     time taken to enrich one row
+    #   count(name)             free-form counters, e.g. rows per outcome status
+    #
+    # Latencies go into fixed-size histograms (LatencyHistogram), so memory stays flat on
+    # runs of millions of rows. summary() returns everything as a dict; write_summary()
+    # and write_prometheus() write it as JSON or as a Prometheus textfile-collector file,
+    # write_metrics() does both.
+    def __init__(self, log_mode='quiet'):
+        if log_mode not in LOG_MODES:
+            raise ValueError(f"Unknown log mode {log_mode!r}; expected one of {', '.join(LOG_MODES)}")
+        self.log_mode = log_mode
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = Counter()
+        self.latencies = defaultdict(LatencyHistogram)
+        self.statuses = defaultdict(Counter)
+        self.retries = Counter()
+        self.errors = Counter()
+        self.counters = Counter()
+        self.row_latencies = LatencyHistogram()
+        self.keepa_tokens_consumed = 0
+        self.keepa_tokens_left = None
+        self._lock = threading.Lock()
+
+    def log(self, message, level='detail', **fields):
+        # level: 'detail' (per row or per API call), 'info' or 'warning' (run-level)
+        if self.log_mode == 'verbose':
+            click.echo(message)
+        elif level != 'detail':
+            if self.log_mode == 'json':
+                record = {'time': round(time.time(), 3), 'level': level, 'message': message.strip(), **fields}
+                click.echo(json.dumps(record, default=str), err=True)
+            else:
+                click.echo(message)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.stage_seconds[name] += elapsed
+                self.stage_calls[name] += 1
+
+    def record_request(self, endpoint, seconds, status=None, retry=False):
+        # status: HTTP status code, or None for a dropped connection or timeout
+        with self._lock:
+            self.latencies[endpoint].add(seconds)
+            self.statuses[endpoint][str(status) if status is not None else 'connection_error'] += 1
+            if retry:
+                self.retries[endpoint] += 1
+
+    def record_error(self, endpoint):
+        with self._lock:
+            self.errors[endpoint] += 1
+
+    def record_keepa_tokens(self, consumed=None, left=None):
+        with self._lock:
+            if consumed:
+                self.keepa_tokens_consumed += int(consumed)
+            if left is not None:
+                self.keepa_tokens_left = int(left)
+
+    def record_row(self, seconds):
+        with self._lock:
+            self.row_latencies.add(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def summary(self, cache=None, image_store=None):
+        with self._lock:
+            endpoints = {}
+            for endpoint in sorted(set(self.latencies) | set(self.errors)):
+                latencies = self.latencies.get(endpoint) or LatencyHistogram()
+                endpoints[endpoint] = {
+                    'requests': latencies.count,
+                    'retries': self.retries[endpoint],
+                    'errors': self.errors[endpoint],
+                    'statuses': dict(self.statuses.get(endpoint, {})),
+                    'latency_seconds': latencies.summary(),
+                }
+            summary = {
+                'started_at': self.started_at,
+                'wall_seconds': round(time.perf_counter() - self._started, 3),
+                'stages': {
+                    name: {'seconds': round(seconds, 3), 'calls': self.stage_calls[name]}
+                    for name, seconds in self.stage_seconds.items()
+                },
+                'endpoints': endpoints,
+                'rows': {
+                    'enriched': self.row_latencies.count,
+                    'latency_seconds': self.row_latencies.summary(),
+                },
+                'counters': dict(self.counters),
+                'keepa_tokens': {'consumed': self.keepa_tokens_consumed, 'left': self.keepa_tokens_left},
+            }
+        if cache is not None:
+            summary['cache'] = cache.stats()
+        if image_store is not None:
+            summary['image_store'] = image_store.stats()
+        return summary
+
+    def write_summary(self, path, cache=None, image_store=None):
+        summary = self.summary(cache=cache, image_store=image_store)
+        _write_atomically(path, json.dumps(summary, indent=2, sort_keys=True) + '\n')
+        return summary
+
+    def write_prometheus(self, path, cache=None, image_store=None):
+        # Text exposition format, for node_exporter's textfile collector
+        summary = self.summary(cache=cache, image_store=image_store)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'{METRIC_PREFIX}_{name}{suffix}{{{label_text}}} {value}' if label_text else f'{METRIC_PREFIX}_{name}{suffix} {value}')
+
+        metric('run_duration_seconds', 'gauge', 'Wall time of the run.', [('', {}, summary['wall_seconds'])])
+        metric('stage_duration_seconds', 'gauge', 'Wall time per pipeline stage.',
+               [('', {'stage': name}, stage['seconds']) for name, stage in summary['stages'].items()])
+        with self._lock:
+            latencies = {endpoint: (np.cumsum(values.buckets).tolist(), values.total, values.count)
+                         for endpoint, values in self.latencies.items()}
+        histogram = []
+        for endpoint, (cumulative, total, count) in sorted(latencies.items()):
+            for bound, bucket_count in zip(LATENCY_BUCKETS, cumulative):
+                histogram.append(('_bucket', {'endpoint': endpoint, 'le': f'{bound:g}'}, bucket_count))
+            histogram.append(('_bucket', {'endpoint': endpoint, 'le': '+Inf'}, count))
+            histogram.append(('_sum', {'endpoint': endpoint}, round(total, 6)))
+            histogram.append(('_count', {'endpoint': endpoint}, count))
+        metric('api_request_duration_seconds', 'histogram', 'Latency of API request attempts.', histogram)
+        metric('api_requests_total', 'counter', 'API request attempts by status.', [
+            ('', {'endpoint': endpoint, 'status': status}, count)
+            for endpoint, stats in summary['endpoints'].items() for status, count in stats['statuses'].items()
+        ])
+        metric('api_retries_total', 'counter', 'API request attempts that were retries.',
+               [('', {'endpoint': endpoint}, stats['retries']) for endpoint, stats in summary['endpoints'].items()])
+        metric('api_errors_total', 'counter', 'API calls that failed after retries.',
+               [('', {'endpoint': endpoint}, stats['errors']) for endpoint, stats in summary['endpoints'].items()])
+        metric('keepa_tokens_consumed_total', 'counter', 'Keepa tokens consumed by the run.',
+               [('', {}, summary['keepa_tokens']['consumed'])])
+        if summary['keepa_tokens']['left'] is not None:
+            metric('keepa_tokens_left', 'gauge', 'Keepa tokens left after the last request.',
+                   [('', {}, summary['keepa_tokens']['left'])])
+        if 'cache' in summary:
+            metric('cache_hits_total', 'counter', 'API response cache hits.',
+                   [('', {'data_class': name}, stats['hits']) for name, stats in summary['cache'].items()])
+            metric('cache_misses_total', 'counter', 'API response cache misses.',
+                   [('', {'data_class': name}, stats['misses']) for name, stats in summary['cache'].items()])
+        metric('events_total', 'counter', 'Pipeline event counters.',
+               [('', {'event': name}, value) for name, value in sorted(summary['counters'].items())])
+
+        _write_atomically(path, '\n'.join(lines) + '\n')
+        return summary
+
+    def write_metrics(self, summary_file, prometheus_file=None, cache=None, image_store=None):
+        summary = self.write_summary(summary_file, cache=cache, image_store=image_store)
+        if prometheus_file:
+            self.write_prometheus(prometheus_file, cache=cache, image_store=image_store)
+        self.log(f"Run summary written to {summary_file} ({summary['wall_seconds']:.1f}s).", level='info')
+        return summary
+
+class LatencyHistogram:
+    # Count, sum, min and max of a stream of latencies, their counts per LATENCY_BUCKETS
+    # bound (the Prometheus histogram) and per PERCENTILE_BUCKETS bound (for percentiles).
+    # Its size is fixed, however many samples are added. Not thread-safe on its own;
+    # Instrumentation adds samples under its lock.
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = np.zeros(len(LATENCY_BUCKETS) + 1, dtype=np.int64) # Last: above every bound
+        self.percentile_buckets = np.zeros(len(PERCENTILE_BUCKETS) + 1, dtype=np.int64)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        # bisect_left finds the first bound >= seconds, i.e. the bucket counting value <= bound
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.percentile_buckets[bisect.bisect_left(PERCENTILE_BUCKETS, seconds)] += 1
+
+    def percentile(self, q):
+        # The geometric middle of the bucket holding the q-th percentile, clamped to the
+        # observed range so that a single sample reports itself exactly
+        rank = max(1, math.ceil(q / 100 * self.count))
+        index = int(np.searchsorted(np.cumsum(self.percentile_buckets), rank))
+        if index == 0:
+            value = PERCENTILE_BUCKETS[0]
+        elif index == len(PERCENTILE_BUCKETS):
+            value = self.max
+        else:
+            value = math.sqrt(PERCENTILE_BUCKETS[index - 1] * PERCENTILE_BUCKETS[index])
+        return min(max(value, self.min), self.max)
+
+    def summary(self):
+        if not self.count:
+            return {}
+        return {
+            'mean': round(self.total / self.count, 4),
+            'p50': round(self.percentile(50), 4),
+            'p90': round(self.percentile(90), 4),
+            'p95': round(self.percentile(95), 4),
+            'p99': round(self.percentile(99), 4),
+            'max': round(self.max, 4),
+        }
+
+def _write_atomically(path, text):
+    # Readers (and the textfile collector) never see a half-written file
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as handle:
+        handle.write(text)
+    os.replace(path + '.tmp', path)
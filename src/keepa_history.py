@@ -0,0 +1,313 @@
+import io
+import os
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# Keepa returns every history as one flattened list: [time, value, time, value, ...],
+# where time is in "Keepa minutes" (minutes since 2011-01-01 UTC) and prices are integer
+# cents/pence, with -1 meaning "no offer". The buy box history carries a third field
+# per point, the seller holding the buy box: [time, price, seller_id, ...].
+#
+# Decoded histories are stored per ASIN as one .npy structured array of HISTORY_DTYPE
+# (13 bytes per point instead of three boxed Python ints) that can be memory-mapped, and
+# the stats below are computed for many ASINs at once on the concatenated arrays.
+
+KEEPA_EPOCH_MINUTES = 21564000 # Keepa minute 0 as minutes since the Unix epoch
+MINUTES_PER_DAY = 24 * 60
+
+# series code: (key in Keepa product 'data', values per point)
+SERIES = {
+    0: ('AMAZON', 2),
+    1: ('SALES_RANK', 2),
+    2: ('BUY_BOX', 3),
+}
+AMAZON, SALES_RANK, BUY_BOX = 0, 1, 2
+
+HISTORY_DTYPE = np.dtype([('series', 'u1'), ('time', '<i4'), ('value', '<i4'), ('seller', '<i4')])
+
+STAT_COLUMNS = [
+    'buy_box_avg_30', 'buy_box_avg_90', 'buy_box_avg_180', 'buy_box_volatility_90',
+    'amazon_avg_90', 'sales_rank_avg_90', 'sales_rank_drops_30', 'sales_rank_drops_90',
+]
+
+_HEADER_DESCR = repr(HISTORY_DTYPE.descr).encode('latin1') # As np.save writes it into .npy headers
+
+DEFAULT_HISTORY_DIR = os.path.join('.cache', 'wholesalefba', 'keepa')
+
+def keepa_minutes_to_unix(minutes):
+    return (np.asarray(minutes, dtype=np.int64) + KEEPA_EPOCH_MINUTES) * 60
+
+def unix_to_keepa_minutes(seconds):
+    return (np.asarray(seconds, dtype=np.int64) // 60 - KEEPA_EPOCH_MINUTES).astype(np.int32)
+
+def seller_code(seller_id):
+    # Buy box seller ids are strings such as 'A3P5ROKL5A1OLE'; they are stored as stable
+    # int32 codes so seller histories stay numeric. Numeric ids are kept as they are.
+    if isinstance(seller_id, (int, np.integer)):
+        return int(seller_id)
+    if seller_id is None or seller_id == '':
+        return -1
+    return zlib.crc32(str(seller_id).encode('utf-8')) & 0x7FFFFFFF
+
+def decode_product(product_data):
+    # Keepa product 'data' dict -> structured array sorted by (series, time)
+    parts = []
+    for code, (key, stride) in SERIES.items():
+        values = product_data.get(key) or []
+        points = len(values) // stride # A trailing partial point is dropped
+        if not points:
+            continue
+        part = np.empty(points, dtype=HISTORY_DTYPE)
+        part['series'] = code
+        if stride == 3:
+            part['time'] = values[0:points * 3:3]
+            part['value'] = values[1:points * 3:3]
+            part['seller'] = [seller_code(seller) for seller in values[2:points * 3:3]]
+        else:
+            flat = np.asarray(values[:points * 2], dtype=np.int64).reshape(points, 2)
+            part['time'] = flat[:, 0]
+            part['value'] = flat[:, 1]
+            part['seller'] = -1
+        parts.append(part[np.argsort(part['time'], kind='stable')])
+    if not parts:
+        return np.empty(0, dtype=HISTORY_DTYPE)
+    return np.concatenate(parts)
+
+def series(history, code):
+    # View of one series of a decoded history (histories are sorted by series)
+    start, stop = np.searchsorted(history['series'], [code, code + 1])
+    return history[start:stop]
+
+def _stats(lengths, points, now):
+    # One row of STAT_COLUMNS per history, the histories concatenated into `points`,
+    # `lengths` points each:
+    #   buy_box_avg_*          time-weighted average buy box price over the last 30/90/180 days
+    #   buy_box_volatility_90  time-weighted standard deviation / mean of the buy box price
+    #   amazon_avg_90          time-weighted average Amazon price
+    #   sales_rank_avg_90      time-weighted average sales rank
+    #   sales_rank_drops_*     sales rank improvements (each roughly one sale) in the window
+    # Prices are returned in pounds, like buy_box_price. Periods without an offer (-1)
+    # do not count towards averages. `now` is a Unix timestamp (default: current time).
+    now_minutes = int(unix_to_keepa_minutes(time.time() if now is None else now))
+    count = len(lengths)
+    all_index = np.repeat(np.arange(count, dtype=np.int32), lengths)
+    all_series = points['series']
+    stats = {}
+
+    index, times, values = _select(all_index, all_series, points, BUY_BOX)
+    for days, (mean, std) in zip((30, 90, 180), _time_weighted(index, times, values, count, now_minutes, (30, 90, 180))):
+        stats[f'buy_box_avg_{days}'] = np.round(mean / 100, 2)
+        if days == 90:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats['buy_box_volatility_90'] = np.round(std / mean, 4)
+
+    index, times, values = _select(all_index, all_series, points, AMAZON)
+    (mean, _), = _time_weighted(index, times, values, count, now_minutes, (90,))
+    stats['amazon_avg_90'] = np.round(mean / 100, 2)
+
+    index, times, values = _select(all_index, all_series, points, SALES_RANK)
+    (mean, _), = _time_weighted(index, times, values, count, now_minutes, (90,))
+    stats['sales_rank_avg_90'] = np.round(mean)
+    for days in (30, 90):
+        stats[f'sales_rank_drops_{days}'] = _rank_drops(index, times, values, count, now_minutes, days)
+
+    return pd.DataFrame(stats, columns=STAT_COLUMNS)
+
+def competitive_sellers(histories, current_prices=None, price_threshold=0.15, lookback_days=90, now=None):
+    # Competitive sellers per history from the buy box history, as a DataFrame with:
+    #   competitive_sellers       effective number of competitive sellers, weighted by how
+    #                             long each held the buy box (inverse Herfindahl index of their
+    #                             time shares: two sellers splitting it evenly count as 2,
+    #                             one holding it 95% of the time and another 5% as about 1.1)
+    #   competitive_seller_count  distinct competitive sellers
+    # A seller is competitive while it holds the buy box within the last `lookback_days`
+    # at a price within `price_threshold` (0.15 = 15%) of the current price. Current prices
+    # are in pounds (e.g. the buy_box_price column); where missing, the last buy box price
+    # in the history is used. Histories without buy box data in the window get NaN.
+    histories = [np.empty(0, dtype=HISTORY_DTYPE) if history is None else history for history in histories]
+    lengths = [len(history) for history in histories]
+    points = np.concatenate(histories).astype(HISTORY_DTYPE, copy=False) if histories else np.empty(0, dtype=HISTORY_DTYPE)
+    return _competitive_sellers(lengths, points, current_prices, price_threshold, lookback_days, now)
+
+def _competitive_sellers(lengths, points, current_prices, price_threshold, lookback_days, now):
+    now_minutes = int(unix_to_keepa_minutes(time.time() if now is None else now))
+    count = len(lengths)
+    all_index = np.repeat(np.arange(count, dtype=np.int32), lengths)
+    mask = points['series'] == BUY_BOX
+    index = all_index[mask]
+    times = points['time'][mask].astype(np.int64)
+    values = points['value'][mask].astype(np.float64)
+    sellers = points['seller'][mask].astype(np.int64)
+
+    # Current price in pence per history: the given price, else the last valid buy box price
+    current = np.full(count, np.nan)
+    valid_positions = np.flatnonzero(values >= 0)
+    valid_index = index[valid_positions]
+    last_valid = np.ones(len(valid_index), dtype=bool)
+    last_valid[:-1] = valid_index[1:] != valid_index[:-1]
+    current[valid_index[last_valid]] = values[valid_positions[last_valid]]
+    if current_prices is not None:
+        given = pd.to_numeric(pd.Series(current_prices), errors='coerce').to_numpy(dtype=float, na_value=np.nan) * 100
+        current = np.where(np.isnan(given), current, given)
+
+    minutes = _window_minutes(times, _next_times(index, times, now_minutes), now_minutes, lookback_days)
+    reference = current[index]
+    with np.errstate(invalid='ignore'):
+        competitive = (values >= 0) & (sellers >= 0) & (np.abs(values - reference) <= price_threshold * reference)
+    competitive &= minutes > 0
+
+    # Buy box minutes per (history, seller) pair, then each seller's share of its history's
+    # competitive buy box time
+    pair_keys, pair_of_point = np.unique(index[competitive].astype(np.int64) << 32 | sellers[competitive], return_inverse=True)
+    pair_minutes = np.bincount(pair_of_point, weights=minutes[competitive], minlength=len(pair_keys))
+    pair_history = (pair_keys >> 32).astype(np.int64)
+    total_minutes = np.bincount(pair_history, weights=pair_minutes, minlength=count)
+    shares = pair_minutes / total_minutes[pair_history]
+    concentration = np.bincount(pair_history, weights=shares ** 2, minlength=count)
+    with np.errstate(divide='ignore'):
+        effective = np.where(concentration > 0, 1 / concentration, 0.0)
+    has_buy_box = np.bincount(index, weights=np.where(values >= 0, minutes, 0), minlength=count) > 0
+    effective[~has_buy_box] = np.nan
+    return pd.DataFrame({
+        'competitive_sellers': np.round(effective, 2),
+        'competitive_seller_count': np.bincount(pair_history, minlength=count),
+    })
+
+def _select(all_index, all_series, points, code):
+    # Points of one series across all histories, still grouped by history and time-ordered
+    mask = all_series == code
+    return all_index[mask], points['time'][mask].astype(np.int64), points['value'][mask].astype(np.float64)
+
+def _time_weighted(index, times, values, count, now_minutes, windows):
+    # Time-weighted (mean, standard deviation) per history for each window in days, NaN
+    # where a window has no valid point. Each point holds its value until the next point of
+    # the same history (the last one until now); only the part inside the window counts.
+    next_times = _next_times(index, times, now_minutes)
+    valid = values >= 0
+
+    results = []
+    for days in windows:
+        weights = _window_minutes(times, next_times, now_minutes, days)
+        weights[~valid] = 0
+        total_weight = np.bincount(index, weights=weights, minlength=count)
+        weighted_values = weights * values
+        weighted_sum = np.bincount(index, weights=weighted_values, minlength=count)
+        weighted_squares = np.bincount(index, weights=weighted_values * values, minlength=count)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(total_weight > 0, weighted_sum / total_weight, np.nan)
+            variance = np.where(total_weight > 0, weighted_squares / total_weight - mean ** 2, np.nan)
+        results.append((mean, np.sqrt(np.clip(variance, 0, None))))
+    return results
+
+def _next_times(index, times, now_minutes):
+    # When each point stops holding: the next point of the same history, or now
+    next_times = np.empty_like(times)
+    next_times[:-1] = times[1:]
+    next_times[-1:] = now_minutes
+    next_times[np.flatnonzero(index[1:] != index[:-1])] = now_minutes # Last point of each history
+    return np.minimum(next_times, now_minutes)
+
+def _window_minutes(times, next_times, now_minutes, days):
+    # Minutes each point held its value within the last `days` days
+    return np.clip(next_times - np.maximum(times, now_minutes - days * MINUTES_PER_DAY), 0, None).astype(np.float64)
+
+def _rank_drops(index, times, values, count, now_minutes, days):
+    same_history = index[1:] == index[:-1]
+    drops = same_history & (values[:-1] > 0) & (values[1:] > 0) & (values[1:] < values[:-1])
+    drops &= times[1:] >= now_minutes - days * MINUTES_PER_DAY
+    return np.bincount(index[1:][drops], minlength=count)
+
+def _points_offset(data):
+    # Every history file is a 1-D HISTORY_DTYPE array saved with np.save, so its points
+    # start right after the version 1.0 .npy header. None for anything else.
+    if data[:8] != b'\x93NUMPY\x01\x00':
+        return None
+    offset = 10 + int.from_bytes(data[8:10], 'little')
+    if (len(data) - offset) % HISTORY_DTYPE.itemsize or _HEADER_DESCR not in data[10:offset]:
+        return None
+    return offset
+
+def _parse_npy(data):
+    offset = _points_offset(data)
+    if offset is not None:
+        return np.frombuffer(data, dtype=HISTORY_DTYPE, offset=offset)
+    try:
+        return np.load(io.BytesIO(data))
+    except ValueError:
+        return None
+
+
+class KeepaHistoryStore:
+    # One <asin>.npy per ASIN under <history_dir>/<last two ASIN characters>/, written
+    # atomically. load() memory-maps a single history; add_stats() reads many at once
+    # without parsing every .npy header with np.load (or holding one mmap per ASIN, which
+    # runs out of file descriptors on a whole catalogue).
+    def __init__(self, history_dir=DEFAULT_HISTORY_DIR):
+        self.history_dir = history_dir
+        os.makedirs(history_dir, exist_ok=True)
+
+    def _path(self, asin):
+        return os.path.join(self.history_dir, asin[-2:], f'{asin}.npy')
+
+    def save(self, asin, history):
+        if not len(history):
+            return
+        path = self._path(asin)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.{id(history)}.tmp'
+        with open(temporary_path, 'wb') as handle:
+            np.save(handle, history)
+        os.replace(temporary_path, path)
+
+    def load(self, asin):
+        if not isinstance(asin, str) or not asin:
+            return None
+        try:
+            return np.load(self._path(asin), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def _read(self, asin):
+        if not isinstance(asin, str) or not asin:
+            return None
+        try:
+            with open(self._path(asin), 'rb') as handle:
+                return handle.read()
+        except OSError:
+            return None
+
+    def _load_points(self, asins):
+        # (points per ASIN, all points) with the raw points of every file joined into one
+        # buffer instead of building and concatenating an array per ASIN
+        lengths, chunks = [], []
+        for asin in asins:
+            data = self._read(asin)
+            offset = _points_offset(data) if data is not None else None
+            if offset is None:
+                history = _parse_npy(data) if data is not None else None
+                data, offset = (history.astype(HISTORY_DTYPE).tobytes(), 0) if history is not None else (b'', 0)
+            chunks.append(memoryview(data)[offset:])
+            lengths.append((len(data) - offset) // HISTORY_DTYPE.itemsize)
+        return lengths, np.frombuffer(b''.join(chunks), dtype=HISTORY_DTYPE)
+
+    def add_stats(self, data_frame, now=None, price_threshold=0.15, lookback_days=90):
+        # Copy of data_frame with STAT_COLUMNS for the ASIN of each row. competitive_sellers
+        # is recomputed against each row's current buy_box_price for rows with buy box
+        # history; other rows keep the value they already had.
+        lengths, points = self._load_points(data_frame['asin'])
+        stats = _stats(lengths, points, now)
+        current_prices = data_frame['buy_box_price'] if 'buy_box_price' in data_frame else None
+        sellers = _competitive_sellers(lengths, points, current_prices, price_threshold, lookback_days, now)
+        stats.index = sellers.index = data_frame.index
+
+        data_frame = data_frame.drop(columns=[column for column in STAT_COLUMNS if column in data_frame])
+        data_frame = pd.concat([data_frame, stats], axis=1)
+        has_buy_box = sellers['competitive_sellers'].notna()
+        if 'competitive_sellers' in data_frame:
+            data_frame['competitive_sellers'] = data_frame['competitive_sellers'].where(~has_buy_box, sellers['competitive_sellers'])
+        else:
+            data_frame['competitive_sellers'] = sellers['competitive_sellers'].where(has_buy_box)
+        return data_frame
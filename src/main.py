@@ -3,8 +3,24 @@ import pandas as pd
 import os
 from src.api_integrator import APIIntegrator
 from src.profit_calculator import ProfitCalculator
+from src.enrichment_engine import EnrichmentEngine, ENRICHED_COLUMNS, flatten_enriched, supplier_row_keys
+from src.run_journal import RunJournal, DEFAULT_JOURNAL_DIR
+from src.incremental import row_fingerprint, reusable_entries, records_frame, change_report, CHANGE_TYPES, DEFAULT_MAX_AGE_DAYS
+from src.response_cache import ResponseCache
+from src.http_client import HTTPClient, RetryPolicy
+from src.image_store import ImageStore, DEFAULT_IMAGE_DIR
+from src.keepa_history import KeepaHistoryStore, DEFAULT_HISTORY_DIR
+from src.instrumentation import Instrumentation, LOG_MODES
 from src.google_sheets_integrator import GoogleSheetsIntegrator
 
+OUTPUT_COLUMNS = [
+    'barcode', 'supplier_buy_price', 'asin', 'title', 'buy_box_price', 'fba_fee', 'referral_fee_percentage',
+    'profit', 'profit_percentage', 'roi', 'estimated_monthly_sales', 'number_of_sellers', 'recommended_units',
+    'amazon_image_url', 'enrichment_status',
+    'buy_box_avg_90', 'buy_box_volatility_90', 'sales_rank_drops_30', 'roi_at_avg_buy_box',
+    'keepa_data', 'jungle_scout_data'
+]
+
 @click.group()
 def cli():
     """A command-line tool for wholesale FBA automation and optimisation."""
@@ -16,106 +32,170 @@ def cli():
 @click.option('--amazon_api_key', envvar='AMAZON_API_KEY', help='Amazon MWS API Key.')
 @click.option('--keepa_api_key', envvar='KEEPA_API_KEY', help='Keepa API Key.')
 @click.option('--jungle_scout_api_key', envvar='JUNGLE_SCOUT_API_KEY', help='Jungle Scout API Key.')
-def process_supplier_data(spreadsheet_name, worksheet_name, amazon_api_key, keepa_api_key, jungle_scout_api_key):
+@click.option('--sp-api-base-url', envvar='SP_API_BASE_URL', help='SP-API base URL (default: the EU production endpoint).')
+@click.option('--keepa-base-url', envvar='KEEPA_BASE_URL', help='Keepa API base URL (default: https://api.keepa.com).')
+@click.option('--jungle-scout-base-url', envvar='JUNGLE_SCOUT_BASE_URL', help='Jungle Scout API base URL (default: https://api.junglescout.com).')
+@click.option('--concurrency', default=8, show_default=True, type=click.IntRange(min=1), help='Number of rows enriched concurrently.')
+@click.option('--min-roi', default=0.0, show_default=True, help='Skip Keepa and Jungle Scout for rows whose best-case ROI (%) from catalog and fee data is below this.')
+@click.option('--min-margin', default=0.0, show_default=True, help='Skip Keepa and Jungle Scout for rows whose best-case profit margin (%) is below this.')
+@click.option('--no-prune', is_flag=True, help='Call Keepa and Jungle Scout for every row, however unprofitable.')
+@click.option('--cache-dir', default=os.path.join('.cache', 'wholesalefba'), show_default=True, help='Directory of the on-disk API response cache.')
+@click.option('--no-cache', is_flag=True, help='Disable the API response cache.')
+@click.option('--refresh', is_flag=True, help='Ignore cached responses but store fresh ones.')
+@click.option('--connect-timeout', default=5.0, show_default=True, help='Seconds to wait for an API connection.')
+@click.option('--timeout', default=30.0, show_default=True, help='Seconds to wait for an API response.')
+@click.option('--max-retries', default=5, show_default=True, type=click.IntRange(min=0), help='Retries per API call on throttling (429), server errors (5xx) and dropped connections.')
+@click.option('--resume', 'resume_run_id', metavar='RUN_ID', help='Resume a previous run, skipping rows it already completed.')
+@click.option('--only-failed', is_flag=True, help='With --resume, retry only the rows that hit API errors.')
+@click.option('--journal-dir', default=DEFAULT_JOURNAL_DIR, show_default=True, help='Directory of per-run result journals.')
+@click.option('--incremental', is_flag=True, help='Reuse the previous run\'s results for rows whose barcode, buy price and pack size are unchanged, and write a change report.')
+@click.option('--previous-run', 'previous_run_id', metavar='RUN_ID', help='With --incremental, the run to compare against (default: the latest run of the same spreadsheet and worksheet in --journal-dir).')
+@click.option('--max-age', 'max_age_days', default=DEFAULT_MAX_AGE_DAYS, show_default=True, type=click.FloatRange(min=0), help='With --incremental, re-enrich unchanged rows whose market data is older than this many days.')
+@click.option('--changes-file', help='With --incremental, where to write the change report (default: reports/changes_<RUN_ID>.csv).')
+@click.option('--prefetch-images', is_flag=True, help='Download supplier and Amazon images into the local image store while enriching.')
+@click.option('--image-dir', default=DEFAULT_IMAGE_DIR, show_default=True, help='Directory of the local image store.')
+@click.option('--history-dir', default=DEFAULT_HISTORY_DIR, show_default=True, help='Directory of decoded per-ASIN Keepa histories.')
+@click.option('--log-mode', type=click.Choice(LOG_MODES), default='quiet', show_default=True, help='quiet: run-level messages only; verbose: also every row and API call; json: run-level messages as JSON lines on stderr.')
+@click.option('--metrics-file', default=os.path.join('reports', 'run_summary.json'), show_default=True, help='Where to write the JSON run summary (stage timings, API latency percentiles, retries, errors, cache and Keepa token usage).')
+@click.option('--prometheus-file', help='Also write the run metrics in Prometheus text format, e.g. for the node_exporter textfile collector.')
+def process_supplier_data(spreadsheet_name, worksheet_name, amazon_api_key, keepa_api_key, jungle_scout_api_key, sp_api_base_url, keepa_base_url, jungle_scout_base_url, concurrency, min_roi, min_margin, no_prune, cache_dir, no_cache, refresh, connect_timeout, timeout, max_retries, resume_run_id, only_failed, journal_dir, incremental, previous_run_id, max_age_days, changes_file, prefetch_images, image_dir, history_dir, log_mode, metrics_file, prometheus_file):
     """Processes supplier data from Google Sheet, enriches it with API data, and writes back to the sheet.
     """
-    click.echo(f"Starting processing for Google Spreadsheet: {spreadsheet_name}, Worksheet: {worksheet_name}")
+    instrumentation = Instrumentation(log_mode)
+    log = instrumentation.log
+    log(f"Starting processing for Google Spreadsheet: {spreadsheet_name}, Worksheet: {worksheet_name}", level='info')
+
+    if only_failed and not resume_run_id:
+        raise click.UsageError("--only-failed requires --resume RUN_ID.")
+    if incremental and resume_run_id:
+        raise click.UsageError("--incremental starts a new run; it cannot be combined with --resume.")
+    # The supplier input, so --incremental compares against an earlier run of the same sheet
+    source = {'spreadsheet': spreadsheet_name, 'worksheet': str(worksheet_name)}
+    try:
+        journal = RunJournal.open_existing(journal_dir, resume_run_id) if resume_run_id else RunJournal(journal_dir, source=source)
+    except FileNotFoundError as e:
+        raise click.UsageError(str(e))
+    log(f"Run ID: {journal.run_id} (resume with --resume {journal.run_id})", level='info', run_id=journal.run_id)
 
     google_sheets_integrator = GoogleSheetsIntegrator()
-    api_integrator = APIIntegrator(amazon_api_key, keepa_api_key, jungle_scout_api_key)
-    profit_calculator = ProfitCalculator()
-
-    supplier_df = google_sheets_integrator.read_sheet_to_dataframe(spreadsheet_name, worksheet_name)
+    cache = None if no_cache else ResponseCache(cache_dir, refresh=refresh)
+    http_client = HTTPClient(
+        timeout=(connect_timeout, timeout),
+        retry_policy=RetryPolicy(max_retries=max_retries),
+        pool_maxsize=max(concurrency, 10),
+        instrumentation=instrumentation
+    )
+    keepa_history = KeepaHistoryStore(history_dir)
+    api_integrator = APIIntegrator(
+        amazon_api_key, keepa_api_key, jungle_scout_api_key, cache=cache, http_client=http_client, keepa_history=keepa_history, instrumentation=instrumentation,
+        sp_api_base_url=sp_api_base_url, keepa_base_url=keepa_base_url, jungle_scout_base_url=jungle_scout_base_url
+    )
+    profit_calculator = ProfitCalculator(instrumentation=instrumentation)
+    enrichment_engine = EnrichmentEngine(
+        api_integrator, concurrency=concurrency, profit_calculator=profit_calculator,
+        min_roi=None if no_prune else min_roi, min_margin=None if no_prune else min_margin
+    )
+
+    with instrumentation.stage('sheet_read'):
+        supplier_df = google_sheets_integrator.read_sheet_to_dataframe(spreadsheet_name, worksheet_name)
     if supplier_df.empty:
-        click.echo("No data found in the specified Google Sheet. Exiting.")
+        log("No data found in the specified Google Sheet. Exiting.", level='warning')
         return
 
-    click.echo(f"Loaded {len(supplier_df)} rows from Google Sheet.")
-
-    processed_data = []
-
-    for index, row in supplier_df.iterrows():
-        barcode = row['barcode'] # Assuming a 'barcode' column in supplier data
-        supplier_buy_price = row['buy_price'] # Assuming a 'buy_price' column
-        
-        click.echo(f"Processing product with barcode: {barcode}")
-
-        # 1. Amazon API Integration
-        # If ASIN is not directly available, attempt to get it from barcode using Keepa API
-        asin = row.get('asin')
-        if not asin and barcode:
-            asin = api_integrator.get_asin_from_barcode(barcode)
-
-        if not asin:
-            click.echo(f"  Skipping {barcode}: ASIN not found or derivable.")
-            continue
-
-        amazon_data = api_integrator.get_amazon_product_data(asin)
-        if not amazon_data:
-            click.echo(f"  Skipping {barcode}: Could not get Amazon data.")
-            continue
-        
-        buy_box_price = amazon_data.get('buy_box_price')
-        fba_fee = amazon_data.get('fba_fee')
-        referral_fee_percentage = amazon_data.get('referral_fee')
-
-        # 2. Keepa API Integration
-        keepa_data = api_integrator.get_keepa_product_data(asin)
-        competitive_sellers = keepa_data.get('competitive_sellers', 1) # Default to 1 to avoid division by zero
-
-        # 3. Jungle Scout API Integration
-        jungle_scout_data = api_integrator.get_jungle_scout_product_data(asin)
-
-        # 4. Profitability Analysis
-        profit = profit_calculator.calculate_profit(
-            buy_box_price,
-            fba_fee,
-            referral_fee_percentage,
-            supplier_buy_price
-        )
-        
-        profit_percentage = profit_calculator.calculate_profit_percentage(profit, buy_box_price)
-        roi = profit_calculator.calculate_roi(profit, supplier_buy_price)
-        
-        estimated_monthly_sales = jungle_scout_data.get('estimated_monthly_sales', 0)
-
-        recommended_units = profit_calculator.calculate_recommended_units(
-            estimated_monthly_sales,
-            competitive_sellers,
-            buy_box_price
-        )
-
-        # Image-based Verification (Image comparison handled by VBA in Google Sheet)
-        supplier_image_url = row.get('supplier_image_url') # Assuming this column exists in your sheet
-        amazon_image_url = amazon_data.get('main_image_url')
-        # The Python script will pull the Amazon image URL and write it back to the sheet.
-        # The VBA macro will then perform the actual image comparison.
-
-        processed_data.append({
-            'barcode': barcode,
-            'supplier_buy_price': supplier_buy_price,
-            'asin': asin,
-            'title': amazon_data.get('title'),
-            'buy_box_price': buy_box_price,
-            'fba_fee': fba_fee,
-            'referral_fee_percentage': referral_fee_percentage,
-            'profit': profit,
-            'profit_percentage': profit_percentage,
-            'roi': roi,
-            'estimated_monthly_sales': estimated_monthly_sales,
-            'number_of_sellers': number_of_sellers,
-            'recommended_units': recommended_units,
-            'amazon_image_url': amazon_image_url, # Write Amazon image URL back to sheet
-            'keepa_data': keepa_data, # Include raw API data for detailed report
-            'jungle_scout_data': jungle_scout_data # Include raw API data
-        })
-    
-    processed_df = pd.DataFrame(processed_data)
+    log(f"Loaded {len(supplier_df)} rows from Google Sheet.", level='info')
+    instrumentation.count('rows_read', len(supplier_df))
+
+    # Rows already completed by this run (or, with --only-failed, everything except the
+    # rows that hit API errors) are served from the run journal instead of the APIs.
+    # Keys are per sheet row: rows repeating a barcode get their own journal entries
+    row_keys = supplier_row_keys(supplier_df)
+    previous = None
+    if incremental:
+        # Unchanged rows with fresh market data are carried over from the previous run's
+        # journal, so only new, changed and stale rows reach the APIs below
+        previous_run_id = previous_run_id or RunJournal.latest_run_id(journal_dir, exclude=journal.run_id, source=source)
+        if previous_run_id:
+            try:
+                previous = RunJournal.open_existing(journal_dir, previous_run_id)
+            except FileNotFoundError as e:
+                raise click.UsageError(str(e))
+            if previous.source != source:
+                log(f"Run {previous_run_id} was not started on this spreadsheet and worksheet; its products will show as removed.", level='warning')
+            fingerprints = supplier_df.apply(row_fingerprint, axis=1)
+            reusable = reusable_entries(previous.entries, row_keys, fingerprints, max_age_days,
+                                        pruned_keys=enrichment_engine.still_pruned(previous.entries))
+            journal.carry_over(reusable.values())
+            log(f"Incremental run against {previous_run_id}: {len(reusable)} unchanged rows reused.", level='info', previous_run_id=previous_run_id, reused=len(reusable))
+            instrumentation.count('rows_reused', len(reusable))
+        else:
+            log("No previous run of this spreadsheet and worksheet to compare against; enriching every row.", level='warning')
+    if only_failed:
+        pending = row_keys.isin(journal.failed_keys())
+    else:
+        # Rows pruned under other floors (or before --no-prune) are enriched again
+        pending = ~row_keys.isin(journal.completed_keys(pruned_keys=enrichment_engine.still_pruned(journal.entries)))
+    log(f"{int(pending.sum())} of {len(supplier_df)} rows need enrichment.", level='info')
+
+    # Images are downloaded in the background while the APIs are being called, so later
+    # image verification reads them from the local store instead of the network.
+    image_store = ImageStore(image_dir, http_client=http_client) if prefetch_images else None
+    if image_store:
+        image_store.prefetch(supplier_df.loc[pending, 'supplier_image_url'].dropna() if 'supplier_image_url' in supplier_df else [])
+
+    def journal_outcome(outcome):
+        record = flatten_enriched(outcome) if outcome['amazon_data'] else None
+        journal.record(outcome['key'], outcome['status'], record, outcome['errors'], fingerprint=row_fingerprint(outcome['row']))
+        if image_store and record and record['amazon_image_url']:
+            image_store.prefetch([record['amazon_image_url']])
+
+    enrichment_engine.enrich(supplier_df[pending], on_result=journal_outcome, keys=row_keys[pending])
+
+    run_summary = journal.summary()
+    log(f"Run {journal.run_id}: {run_summary['ok']} enriched, {run_summary['pruned']} pruned as unprofitable, {run_summary['skipped']} skipped, {run_summary['error']} with API errors.", level='info', **run_summary)
+    if run_summary['error']:
+        log(f"Retry the failed rows with --resume {journal.run_id} --only-failed", level='warning')
+
+    # The output is rebuilt from the journal, in supplier order
+    record_keys = [key for key in row_keys if key in journal.entries and journal.entries[key]['record']]
+    records = [journal.entries[key]['record'] for key in record_keys]
+
+    # 4. Profitability Analysis (vectorised over all enriched rows at once)
+    # Image-based verification is handled by VBA in the Google Sheet: the Amazon image URL
+    # is written back to the sheet and the macro performs the actual image comparison.
+    # Price and rank history stats are computed for all rows at once from the stored Keepa histories
+    with instrumentation.stage('history_stats'):
+        enriched_df = keepa_history.add_stats(pd.DataFrame(records, columns=ENRICHED_COLUMNS))
+    with instrumentation.stage('scoring'):
+        processed_df = profit_calculator.score_dataframe(enriched_df)
+    processed_df = processed_df[OUTPUT_COLUMNS]
+
+    if previous is not None:
+        with instrumentation.stage('change_report'):
+            current_df = processed_df.set_axis(pd.Index(record_keys, name='key'))
+            changes_df = change_report(records_frame(previous.entries), current_df, profit_calculator=profit_calculator)
+        changes_file = changes_file or os.path.join('reports', f'changes_{journal.run_id}.csv')
+        os.makedirs(os.path.dirname(changes_file) or '.', exist_ok=True)
+        changes_df.to_csv(changes_file, index=False)
+        counts = changes_df['change'].value_counts()
+        log(f"Changes since {previous.run_id}: " + ', '.join(f"{int(counts.get(change, 0))} {change.replace('_', ' ')}" for change in CHANGE_TYPES) + f" (written to {changes_file})",
+            level='info', **{change: int(counts.get(change, 0)) for change in CHANGE_TYPES})
 
     # Write processed data back to Google Sheet
-    google_sheets_integrator.write_dataframe_to_sheet(processed_df, spreadsheet_name, worksheet_name)
-
-    click.echo("Processing complete. Check your Google Sheet for the updated data.")
+    with instrumentation.stage('sheet_write'):
+        google_sheets_integrator.write_dataframe_to_sheet(processed_df, spreadsheet_name, worksheet_name)
+
+    if cache:
+        for data_class, stats in cache.stats().items():
+            log(f"Cache {data_class}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)", level='info')
+    if image_store:
+        image_store.close() # Waits for outstanding image downloads
+        log(f"Image store: {image_store.stats()['failed']} images could not be downloaded.", level='info')
+    instrumentation.write_metrics(metrics_file, prometheus_file, cache=cache, image_store=image_store)
+    if cache:
+        cache.close()
+    http_client.close()
+
+    log("Processing complete. Check your Google Sheet for the updated data.", level='info')
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
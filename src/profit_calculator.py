@@ -1,21 +1,127 @@
-import click
+import numpy as np
 import pandas as pd
+from src.instrumentation import Instrumentation
 
 class ProfitCalculator:
+    def __init__(self, instrumentation=None):
+        self.instrumentation = instrumentation or Instrumentation()
+
     def calculate_profit(self, buy_box_price, fba_fee, referral_fee_percentage, supplier_buy_price, vat_rate=0.20):
         # Profit = (Buy Box Price - (Amazon Fulfilment Cost + Amazon Referral Fee + VAT)) - Supplier Buy Price
+        if None in (buy_box_price, fba_fee, referral_fee_percentage, supplier_buy_price):
+            return None
         referral_fee_amount = buy_box_price * referral_fee_percentage
         vat_amount = (buy_box_price - supplier_buy_price - fba_fee - referral_fee_amount) * vat_rate
         total_amazon_fees = fba_fee + referral_fee_amount + vat_amount
         profit = buy_box_price - total_amazon_fees - supplier_buy_price
         return round(profit, 2)
 
+    def calculate_profit_percentage(self, profit, buy_box_price):
+        # Profit % = Profit / Buy Box Price * 100
+        if profit is None or not buy_box_price:
+            return None
+        return round(profit / buy_box_price * 100, 2)
+
+    def calculate_roi(self, profit, supplier_buy_price):
+        # ROI = Profit / Supplier Buy Price * 100
+        if profit is None or not supplier_buy_price:
+            return None
+        return round(profit / supplier_buy_price * 100, 2)
+
     def calculate_recommended_units(self, estimated_monthly_sales, number_of_sellers, buy_box_price, seller_price_threshold=0.15):
         # Recommended Units = Monthly Sales (from Jungle Scout) / Number of sellers within 15% of Buy Box Price
-        # For simplicity, we'll assume sellers within 15% of Buy Box Price are considered competitive
-        competitive_sellers = number_of_sellers # In a real scenario, this would be filtered based on price
+        # number_of_sellers should be the competitive_sellers figure from the Keepa buy box
+        # history (src/keepa_history.py), which already applies the price filter and may be fractional
+        competitive_sellers = number_of_sellers
         if competitive_sellers == 0:
             return estimated_monthly_sales # If no competitive sellers, recommend all sales
-        
+
         recommended_units = estimated_monthly_sales / competitive_sellers
         return round(recommended_units)
+
+    # --- Columnar API ---
+    # The methods below apply the same formulas to whole columns at once. Missing inputs
+    # (None/NaN/non-numeric) propagate as NaN instead of raising, a zero buy box price
+    # gives a NaN profit %, and a zero supplier price gives a NaN ROI.
+
+    def profit_array(self, buy_box_price, fba_fee, referral_fee_percentage, supplier_buy_price, vat_rate=0.20):
+        buy_box_price = self._as_array(buy_box_price)
+        fba_fee = self._as_array(fba_fee)
+        referral_fee_percentage = self._as_array(referral_fee_percentage)
+        supplier_buy_price = self._as_array(supplier_buy_price)
+        vat_rate = self._as_array(vat_rate)
+
+        referral_fee_amount = buy_box_price * referral_fee_percentage
+        margin_before_vat = buy_box_price - supplier_buy_price - fba_fee - referral_fee_amount
+        return np.round(margin_before_vat * (1 - vat_rate), 2)
+
+    def profit_percentage_array(self, profit, buy_box_price):
+        return self._percentage(profit, buy_box_price)
+
+    def roi_array(self, profit, supplier_buy_price):
+        return self._percentage(profit, supplier_buy_price)
+
+    def recommended_units_array(self, estimated_monthly_sales, competitive_sellers):
+        estimated_monthly_sales = self._as_array(estimated_monthly_sales)
+        competitive_sellers = self._as_array(competitive_sellers)
+        # No (or unknown) competitive sellers means the whole monthly demand is available
+        sellers = np.where(np.isnan(competitive_sellers) | (competitive_sellers <= 0), 1.0, competitive_sellers)
+        return np.round(estimated_monthly_sales / sellers)
+
+    def score_dataframe(self, data_frame, vat_rate=0.20):
+        # Adds profit, profit_percentage, roi and recommended_units columns to a copy of an
+        # enriched DataFrame (plus roi_at_avg_buy_box when Keepa history stats are present).
+        # A 'vat_rate' column, where present, overrides the default rate per row (e.g.
+        # zero-rated goods); blank cells fall back to `vat_rate`.
+        self.instrumentation.log(f"  Scoring {len(data_frame)} rows...", level='info')
+        scored = data_frame.copy()
+        row_vat_rate = np.full(len(scored), vat_rate, dtype=float)
+        if 'vat_rate' in scored:
+            row_vat_rate = np.where(np.isnan(self._as_array(scored['vat_rate'])), vat_rate, self._as_array(scored['vat_rate']))
+
+        profit = self.profit_array(
+            self._column(scored, 'buy_box_price'),
+            self._column(scored, 'fba_fee'),
+            self._column(scored, 'referral_fee_percentage'),
+            self._column(scored, 'supplier_buy_price'),
+            row_vat_rate
+        )
+        scored['profit'] = profit
+        scored['profit_percentage'] = self.profit_percentage_array(profit, self._column(scored, 'buy_box_price'))
+        scored['roi'] = self.roi_array(profit, self._column(scored, 'supplier_buy_price'))
+        scored['recommended_units'] = self.recommended_units_array(
+            self._column(scored, 'estimated_monthly_sales'),
+            self._column(scored, 'competitive_sellers')
+        )
+        if 'buy_box_avg_90' in scored:
+            # Keepa history stats (src/keepa_history.py): ROI if the buy box reverts to its
+            # 90-day average, which exposes products that only look profitable on a price spike
+            average_profit = self.profit_array(
+                self._column(scored, 'buy_box_avg_90'),
+                self._column(scored, 'fba_fee'),
+                self._column(scored, 'referral_fee_percentage'),
+                self._column(scored, 'supplier_buy_price'),
+                row_vat_rate
+            )
+            scored['roi_at_avg_buy_box'] = self.roi_array(average_profit, self._column(scored, 'supplier_buy_price'))
+        return scored
+
+    def _percentage(self, numerator, denominator):
+        numerator = self._as_array(numerator)
+        denominator = self._as_array(denominator)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentage = np.where(denominator != 0, numerator / denominator * 100, np.nan)
+        return np.round(percentage, 2)
+
+    def _column(self, data_frame, column):
+        if column not in data_frame:
+            return np.full(len(data_frame), np.nan)
+        return self._as_array(data_frame[column])
+
+    @staticmethod
+    def _as_array(values):
+        if np.isscalar(values) or values is None:
+            return np.float64(np.nan if values is None else values)
+        if isinstance(values, np.ndarray) and values.dtype.kind == 'f':
+            return values.astype(float, copy=False)
+        return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class TokenBucket:
+    # Classic token bucket: `rate` tokens are added per second, up to `capacity`.
+    # acquire() blocks until enough tokens are available, so callers are paced at
+    # `rate` requests per second with bursts of at most `capacity` requests.
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class UpstreamLimiter:
+    # Rate limit and concurrency cap for a single upstream API (SP-API, Keepa, Jungle Scout).
+    # Used as a context manager around each HTTP call:
+    #
+    #     with limiter:
+    #         response = session.get(...)
+    #
+    # `rate`/`burst` feed a TokenBucket (None disables pacing) and `max_in_flight`
+    # bounds the number of simultaneous requests (None disables the cap).
+    def __init__(self, name, rate=None, burst=None, max_in_flight=None):
+        self.name = name
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._semaphore = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+
+    def __enter__(self):
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        if self._bucket is not None:
+            self._bucket.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._semaphore is not None:
+            self._semaphore.release()
+        return False
@@ -1,32 +1,140 @@
-import click
 import pandas as pd
 import os
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
+from src.instrumentation import Instrumentation
+from src.streaming_pipeline import NESTED_COLUMNS
+
+REPORT_SHEET = 'Wholesale Analysis'
+DETAIL_SHEET = 'API Detail'
+DEFAULT_FORMATS = ('xlsx', 'parquet', 'csv')
+DETAIL_KEY_COLUMNS = ['barcode', 'asin']
+MONEY_COLUMNS = ['supplier_buy_price', 'buy_box_price', 'fba_fee', 'profit']
+EXCEL_MAX_ROWS = 1048576 # Including the header row
+WRITE_BLOCK_ROWS = 10000
 
 class ReportGenerator:
-    def generate_report(self, data_frame, output_file='wholesale_report.xlsx'):
-        click.echo(f"Generating comprehensive report to {output_file}...")
-        
-        # Save to Excel
-        writer = pd.ExcelWriter(output_file, engine='openpyxl')
-        workbook = writer.book
-        worksheet = writer.sheets['Wholesale Analysis']
-
-        # Apply conditional formatting (placeholder logic)
-        # Example: Color rows based on Profit % or ROI
-        # You would define your own thresholds and colors here.
-        green_fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid") # Light green
-        red_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")   # Light red
-
-        # Assuming 'profit_percentage' and 'roi' columns exist in data_frame
-        for row_idx, row_data in data_frame.iterrows():
-            if 'profit_percentage' in row_data and row_data['profit_percentage'] > 10:
-                for cell in worksheet[row_idx + 2]: # +2 because of header row and 0-based index
-                    cell.fill = green_fill
-            elif 'roi' in row_data and row_data['roi'] < 0:
-                for cell in worksheet[row_idx + 2]:
-                    cell.fill = red_fill
-
-        writer.close()
-        click.echo("Report generation complete.")
\ No newline at end of file
+    # Writes the analysis in up to three formats with the same file stem, e.g.
+    # wholesale_report.xlsx, wholesale_report.parquet and wholesale_report.csv.
+    #
+    # Nested API payloads (keepa_data, jungle_scout_data) are kept out of the main table:
+    #   xlsx     a second sheet (DETAIL_SHEET) with one column per scalar field
+    #   parquet  <stem>_detail.parquet with native struct and list columns, histories included
+    #   csv      <stem>_detail.csv with one column per scalar field
+    #
+    # The workbook is written with xlsxwriter in constant_memory mode, row by row, so
+    # memory does not grow with the report. Cell text is always written as a string:
+    # supplier and Amazon titles starting with '=' do not become formulas, and URLs do not
+    # become hyperlinks (Excel allows 65,530 per sheet). Rows are coloured by native conditional
+    # formatting rules that Excel evaluates itself: green where profit_percentage is above
+    # `profitable_percentage`, otherwise red where roi is negative.
+    def __init__(self, profitable_percentage=10, formats=DEFAULT_FORMATS, instrumentation=None):
+        self.profitable_percentage = profitable_percentage
+        self.instrumentation = instrumentation or Instrumentation()
+        self.formats = formats
+
+    def generate_report(self, data_frame, output_file='wholesale_report.xlsx', formats=None):
+        self.instrumentation.log(f"Generating comprehensive report to {output_file}...", level='info')
+        formats = formats or self.formats
+        stem = os.path.splitext(output_file)[0]
+        os.makedirs(os.path.dirname(stem) or '.', exist_ok=True)
+
+        nested_columns = [column for column in NESTED_COLUMNS if column in data_frame]
+        summary_df = data_frame.drop(columns=nested_columns).reset_index(drop=True)
+        detail_df = self.detail_frame(data_frame, nested_columns)
+        flat_detail_df = self.flatten_detail(detail_df, nested_columns)
+
+        written = []
+        if 'xlsx' in formats:
+            if len(summary_df) >= EXCEL_MAX_ROWS:
+                self.instrumentation.log(f"  {len(summary_df)} rows exceed the Excel sheet limit; skipping {stem}.xlsx.", level='warning')
+            else:
+                self._write_excel(summary_df, flat_detail_df, stem + '.xlsx')
+                written.append(stem + '.xlsx')
+        if 'parquet' in formats:
+            summary_df.to_parquet(stem + '.parquet', index=False)
+            written.append(stem + '.parquet')
+            if nested_columns:
+                detail_df.to_parquet(stem + '_detail.parquet', index=False)
+                written.append(stem + '_detail.parquet')
+        if 'csv' in formats:
+            summary_df.to_csv(stem + '.csv', index=False)
+            written.append(stem + '.csv')
+            if nested_columns:
+                flat_detail_df.to_csv(stem + '_detail.csv', index=False)
+                written.append(stem + '_detail.csv')
+
+        self.instrumentation.log(f"Report generation complete: {', '.join(written)}", level='info')
+        return written
+
+    @staticmethod
+    def detail_frame(data_frame, nested_columns):
+        # Identifiers plus the nested payloads as dicts (None where a row has none)
+        keys = [column for column in DETAIL_KEY_COLUMNS if column in data_frame]
+        detail_df = data_frame[keys + nested_columns].reset_index(drop=True)
+        for column in nested_columns:
+            detail_df[column] = [value if isinstance(value, dict) and value else None for value in detail_df[column]]
+        return detail_df
+
+    @staticmethod
+    def flatten_detail(detail_df, nested_columns):
+        # One column per scalar field, named <payload>.<field> (e.g. keepa_data.competitive_sellers).
+        # History arrays do not fit a cell; they are only kept in the Parquet detail file.
+        flat_df = detail_df.drop(columns=nested_columns)
+        for column in nested_columns:
+            fields = pd.DataFrame.from_records([value or {} for value in detail_df[column]], index=flat_df.index)
+            scalar_fields = [field for field in fields.columns if not fields[field].map(lambda value: isinstance(value, (list, dict))).any()]
+            flat_df = pd.concat([flat_df, fields[scalar_fields].add_prefix(f'{column}.')], axis=1)
+        return flat_df
+
+    def _write_excel(self, summary_df, detail_df, output_file):
+        workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'strings_to_formulas': False, 'strings_to_urls': False})
+        try:
+            header_format = workbook.add_format({'bold': True, 'bottom': 1})
+            money_format = workbook.add_format({'num_format': '#,##0.00'})
+            worksheet = self._write_sheet(workbook, REPORT_SHEET, summary_df, header_format, money_format)
+            self._add_row_colours(workbook, worksheet, summary_df)
+            if len(detail_df.columns) > len(DETAIL_KEY_COLUMNS):
+                self._write_sheet(workbook, DETAIL_SHEET, detail_df, header_format, money_format)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def _write_sheet(workbook, name, data_frame, header_format, money_format):
+        worksheet = workbook.add_worksheet(name)
+        # Column widths and formats must be set before any row is written in constant_memory mode
+        for index, column in enumerate(data_frame.columns):
+            worksheet.set_column(index, index, max(10, min(40, len(str(column)) + 2)), money_format if column in MONEY_COLUMNS else None)
+        worksheet.freeze_panes(1, 0)
+        worksheet.write_row(0, 0, [str(column) for column in data_frame.columns], header_format)
+
+        # A block of rows at a time, as Python objects with None for missing values (written
+        # as blanks), so only WRITE_BLOCK_ROWS rows are ever converted at once
+        for start in range(0, len(data_frame), WRITE_BLOCK_ROWS):
+            block = data_frame.iloc[start:start + WRITE_BLOCK_ROWS].astype(object)
+            block = block.where(block.notna(), None)
+            for row_number, values in enumerate(block.itertuples(index=False, name=None), start=start + 1):
+                worksheet.write_row(row_number, 0, values)
+        if len(data_frame.columns):
+            worksheet.autofilter(0, 0, len(data_frame), len(data_frame.columns) - 1)
+        return worksheet
+
+    def _add_row_colours(self, workbook, worksheet, data_frame):
+        if data_frame.empty:
+            return
+        last_row, last_column = len(data_frame), len(data_frame.columns) - 1
+        rules = []
+        if 'profit_percentage' in data_frame:
+            column = xl_col_to_name(data_frame.columns.get_loc('profit_percentage'))
+            rules.append((f'=AND(ISNUMBER(${column}2), ${column}2>{self.profitable_percentage})', '#C6EFCE')) # Light green
+        if 'roi' in data_frame:
+            column = xl_col_to_name(data_frame.columns.get_loc('roi'))
+            rules.append((f'=AND(ISNUMBER(${column}2), ${column}2<0)', '#FFC7CE')) # Light red
+        # The first matching rule wins, as in the original if/elif colouring
+        for formula, colour in rules:
+            worksheet.conditional_format(1, 0, last_row, last_column, {
+                'type': 'formula',
+                'criteria': formula,
+                'format': workbook.add_format({'bg_color': colour}),
+                'stop_if_true': True,
+            })
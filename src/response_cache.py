@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# Time-to-live per class of API data, in seconds. Barcode -> ASIN mappings practically
+# never change, fee schedules change at most daily, while catalog responses carry the
+# current buy box price and go stale within minutes.
+DEFAULT_TTLS = {
+    'barcode': 90 * 24 * 3600,
+    'catalog': 15 * 60,
+    'fees': 24 * 3600,
+    'keepa': 6 * 3600,
+    'jungle_scout': 24 * 3600,
+}
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+class ResponseCache:
+    # On-disk SQLite cache for API responses, keyed by endpoint plus normalised request
+    # parameters. Entries expire after the TTL of their data class, and the least
+    # recently used entries are evicted once the stored payloads exceed `max_bytes`.
+    # With `refresh=True` every lookup misses but fresh responses are still stored.
+    def __init__(self, cache_dir, ttls=None, max_bytes=DEFAULT_MAX_BYTES, refresh=False):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'responses.sqlite3')
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = Counter()
+        self.misses = Counter()
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, data_class TEXT NOT NULL, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(endpoint, params):
+        # API keys never belong in params; values are stringified and stripped so that
+        # e.g. barcode 5012345678900 and "5012345678900 " share an entry.
+        normalized = {str(name): str(value).strip() for name, value in sorted((params or {}).items())}
+        return f"{endpoint}?{json.dumps(normalized, sort_keys=True, separators=(',', ':'))}"
+
+    def get(self, data_class, endpoint, params):
+        if self.refresh:
+            self.misses[data_class] += 1
+            return None
+
+        key = self.make_key(endpoint, params)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttls.get(data_class, 0):
+                self.misses[data_class] += 1
+                return None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits[data_class] += 1
+        return json.loads(row[0])
+
+    def set(self, data_class, endpoint, params, value):
+        if value is None:
+            return
+        key = self.make_key(endpoint, params)
+        payload = json.dumps(value, separators=(',', ':'))
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, data_class, value, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, data_class, payload, len(payload), now, now),
+            )
+            self._connection.commit()
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= 1000:
+                self._evict()
+
+    def _evict(self):
+        # Drops the least recently used entries until the cache is back under 90% of max_bytes.
+        # Expects self._lock to be held.
+        self._writes_since_eviction = 0
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - int(self.max_bytes * 0.9)
+        stale_keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            stale_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+        self._connection.commit()
+
+    def stats(self):
+        data_classes = sorted(set(self.hits) | set(self.misses))
+        stats = {}
+        for data_class in data_classes:
+            hits, misses = self.hits[data_class], self.misses[data_class]
+            stats[data_class] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._connection.close()
@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_JOURNAL_DIR = os.path.join('.cache', 'wholesalefba', 'runs')
+# 'pruned' rows are not among them: whether a row is settled by pruning depends on the
+# profit floors of the run that reads the journal (EnrichmentEngine.still_pruned)
+COMPLETED_STATUSES = ('ok', 'skipped')
+
+class RunJournal:
+    # Append-only log of per-row results for one run, stored as JSON lines in
+    # <journal_dir>/<run_id>.jsonl. Every row outcome is appended (and flushed) as soon
+    # as the row completes, so a crash or throttling at row 14,000 loses nothing that
+    # was already paid for. Reopening a run replays the file; the last entry per row
+    # key wins, which is how retried rows replace their earlier failures.
+    #
+    # Entries also carry the row's supplier fingerprint and when its market data was
+    # fetched (fetched_at), which incremental runs (src/incremental.py) use to carry
+    # results over from a previous run; carried-over entries keep their fetched_at.
+    #
+    # `source` identifies the supplier input of a new run (e.g. its spreadsheet and
+    # worksheet). It is written once to <run_id>.source.json next to the journal, so
+    # incremental runs can find the previous run of the same supplier.
+    def __init__(self, journal_dir=DEFAULT_JOURNAL_DIR, run_id=None, source=None):
+        self.run_id = run_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.path = os.path.join(journal_dir, f"{self.run_id}.jsonl")
+        self.entries = {}
+        self._lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            self._replay()
+        source_path = self._source_path(journal_dir, self.run_id)
+        if source is not None and not os.path.exists(source_path):
+            with open(source_path, 'w', encoding='utf-8') as handle:
+                json.dump(source, handle)
+        self.source = self.read_source(journal_dir, self.run_id)
+
+    @staticmethod
+    def _source_path(journal_dir, run_id):
+        return os.path.join(journal_dir, f"{run_id}.source.json")
+
+    @classmethod
+    def read_source(cls, journal_dir, run_id):
+        # The source a run was started with, or None for runs journalled without one
+        try:
+            with open(cls._source_path(journal_dir, run_id), encoding='utf-8') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def latest_run_id(cls, journal_dir, exclude=None, source=None):
+        # Run IDs start with their start time, so the last one in name order is the newest.
+        # With `source`, only runs started on that same source are considered.
+        if not os.path.isdir(journal_dir):
+            return None
+        run_ids = sorted((name[:-len('.jsonl')] for name in os.listdir(journal_dir) if name.endswith('.jsonl')), reverse=True)
+        for run_id in run_ids:
+            if run_id != exclude and (source is None or cls.read_source(journal_dir, run_id) == source):
+                return run_id
+        return None
+
+    @classmethod
+    def open_existing(cls, journal_dir, run_id):
+        if not os.path.exists(os.path.join(journal_dir, f"{run_id}.jsonl")):
+            raise FileNotFoundError(f"No journal for run {run_id} in {journal_dir}")
+        return cls(journal_dir, run_id)
+
+    def _replay(self):
+        with open(self.path, encoding='utf-8') as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # A torn final line from a crash mid-write
+                self.entries[entry['key']] = entry
+
+    def record(self, key, status, record=None, errors=None, fingerprint=None, fetched_at=None):
+        recorded_at = time.time()
+        entry = {'key': key, 'status': status, 'record': record, 'errors': errors or [], 'recorded_at': recorded_at,
+                 'fingerprint': fingerprint, 'fetched_at': fetched_at or recorded_at}
+        line = json.dumps(entry, default=_json_default) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as handle:
+                handle.write(line)
+            self.entries[key] = json.loads(line)
+
+    def carry_over(self, entries):
+        # Copies entries from a previous run into this one, keeping their fingerprint and
+        # fetched_at so the age of their market data is still known
+        recorded_at = time.time()
+        carried = [{**entry, 'recorded_at': recorded_at, 'fetched_at': entry.get('fetched_at') or entry['recorded_at']} for entry in entries]
+        lines = ''.join(json.dumps(entry, default=_json_default) + '\n' for entry in carried)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as handle:
+                handle.write(lines)
+            for entry in carried:
+                self.entries[entry['key']] = entry
+
+    def completed_keys(self, pruned_keys=()):
+        # Rows that need no further API calls: enriched, or skipped without any API error,
+        # plus the pruned rows in pruned_keys (those the current floors still prune)
+        return {key for key, entry in self.entries.items()
+                if entry['status'] in COMPLETED_STATUSES or (entry['status'] == 'pruned' and key in pruned_keys)}
+
+    def failed_keys(self):
+        return {key for key, entry in self.entries.items() if entry['status'] == 'error'}
+
+    def summary(self):
+        counts = {'ok': 0, 'pruned': 0, 'skipped': 0, 'error': 0}
+        for entry in self.entries.values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return counts
+
+def _json_default(value):
+    # numpy scalars and pandas missing values from DataFrame rows
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is pd.NA or value is pd.NaT:
+        return None
+    return str(value)
@@ -0,0 +1,168 @@
+import click
+import numpy as np
+import pandas as pd
+from src.profit_calculator import ProfitCalculator
+
+# What-if repricing: profit and ROI for every product across a grid of buy prices,
+# buy box prices and VAT treatments, computed from already-enriched data (no API calls).
+#
+# The grid is expressed as relative changes: a buy box factor of -0.05 means "buy box
+# price 5% below today's", a buy price factor of -0.10 means "10% off the supplier price".
+# Products are processed in chunks so that chunk_rows x grid_points stays under
+# `max_cells`, which keeps memory flat for 10k products x 1k grid points and beyond.
+# sweep_scenarios() reduces each chunk to one summary row per product; sweep_grid() yields
+# the full grid, one long-format frame (a row per product and scenario) per chunk.
+
+DEFAULT_BUY_BOX_FACTORS = np.round(np.arange(-0.20, 0.10 + 1e-9, 0.01), 4)
+DEFAULT_BUY_PRICE_FACTORS = np.round(np.arange(-0.30, 0.0 + 1e-9, 0.01), 4)
+DEFAULT_VAT_RATES = (0.20, 0.0)
+DEFAULT_MAX_CELLS = 2_000_000
+
+REQUIRED_COLUMNS = ['buy_box_price', 'fba_fee', 'referral_fee_percentage', 'supplier_buy_price']
+
+def parse_range(value):
+    # "start:stop:step" (inclusive) or a comma-separated list, e.g. "-0.2:0.1:0.01" or "0.2,0"
+    if ':' in value:
+        start, stop, step = (float(part) for part in value.split(':'))
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    return np.array([float(part) for part in value.split(',') if part.strip()])
+
+def read_enriched_data(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith(('.xlsx', '.xls')):
+        return pd.read_excel(path)
+    return pd.read_csv(path, dtype={'barcode': str})
+
+def sweep_scenarios(data_frame, buy_box_factors=DEFAULT_BUY_BOX_FACTORS, buy_price_factors=DEFAULT_BUY_PRICE_FACTORS,
+                    vat_rates=DEFAULT_VAT_RATES, target_roi=30.0, max_cells=DEFAULT_MAX_CELLS, profit_calculator=None):
+    # Returns one summary row per input row:
+    #   break_even_buy_price            highest buy price with zero profit at today's buy box
+    #   break_even_buy_price_low        the same at the lowest buy box price in the grid
+    #   max_buy_price_for_target_roi_*  highest buy price that still reaches `target_roi` (%)
+    #                                   at today's buy box, per VAT rate
+    #   min_buy_box_price_for_target_roi_*
+    #                                   lowest buy box price that still reaches `target_roi` (%)
+    #                                   at today's supplier price, per VAT rate
+    #   profitable_share                share of grid scenarios with a positive profit
+    # (ROI falls with the buy price and rises with the buy box price, so the best grid
+    # scenario is always the cheapest buy price at the highest buy box: a grid corner.)
+    profit_calculator = profit_calculator or ProfitCalculator()
+    buy_box_factors, buy_price_factors, vat_rates = _factors(buy_box_factors, buy_price_factors, vat_rates)
+    summaries = [
+        _sweep_chunk(profit_calculator, columns, buy_box_factors, buy_price_factors, vat_rates, target_roi)
+        for _, columns in _chunks(data_frame, buy_box_factors, buy_price_factors, vat_rates, max_cells)
+    ]
+
+    summary = data_frame[_identifiers(data_frame) + REQUIRED_COLUMNS].reset_index(drop=True)
+    if summaries:
+        summary = pd.concat([summary, pd.concat(summaries, ignore_index=True)], axis=1)
+    return summary
+
+def sweep_grid(data_frame, buy_box_factors=DEFAULT_BUY_BOX_FACTORS, buy_price_factors=DEFAULT_BUY_PRICE_FACTORS,
+               vat_rates=DEFAULT_VAT_RATES, max_cells=DEFAULT_MAX_CELLS, profit_calculator=None):
+    # Yields the profit and ROI of every product in every grid scenario as long-format
+    # frames of at most about `max_cells` rows each, one per chunk of products: the
+    # identifiers, the scenario (buy_box_factor, buy_price_factor, vat_rate), the buy box
+    # and buy prices it implies, and profit and roi (%). Write each frame out before asking
+    # for the next to keep memory flat.
+    profit_calculator = profit_calculator or ProfitCalculator()
+    buy_box_factors, buy_price_factors, vat_rates = _factors(buy_box_factors, buy_price_factors, vat_rates)
+    identifiers = data_frame[_identifiers(data_frame)].reset_index(drop=True)
+    grid_points = len(buy_box_factors) * len(buy_price_factors) * len(vat_rates)
+
+    for start, columns in _chunks(data_frame, buy_box_factors, buy_price_factors, vat_rates, max_cells):
+        rows = len(columns['buy_box_price'])
+        # Axes: (product, buy box scenario, buy price scenario, VAT scenario), flattened in that order
+        buy_box_grid = columns['buy_box_price'][:, None, None, None] * (1 + buy_box_factors[None, :, None, None])
+        buy_price_grid = columns['supplier_buy_price'][:, None, None, None] * (1 + buy_price_factors[None, None, :, None])
+        profit = profit_calculator.profit_array(
+            buy_box_grid,
+            columns['fba_fee'][:, None, None, None],
+            columns['referral_fee_percentage'][:, None, None, None],
+            buy_price_grid,
+            vat_rates[None, None, None, :]
+        )
+        shape = profit.shape
+        grid = identifiers.iloc[np.repeat(np.arange(start, start + rows), grid_points)].reset_index(drop=True)
+        grid['buy_box_factor'] = np.broadcast_to(buy_box_factors[None, :, None, None], shape).ravel()
+        grid['buy_price_factor'] = np.broadcast_to(buy_price_factors[None, None, :, None], shape).ravel()
+        grid['vat_rate'] = np.broadcast_to(vat_rates[None, None, None, :], shape).ravel()
+        grid['buy_box_price'] = np.round(np.broadcast_to(buy_box_grid, shape).ravel(), 2)
+        grid['supplier_buy_price'] = np.round(np.broadcast_to(buy_price_grid, shape).ravel(), 2)
+        grid['profit'] = profit.ravel()
+        grid['roi'] = profit_calculator.roi_array(profit, buy_price_grid).ravel()
+        yield grid
+
+def _factors(buy_box_factors, buy_price_factors, vat_rates):
+    return (np.asarray(buy_box_factors, dtype=float), np.asarray(buy_price_factors, dtype=float),
+            np.asarray(vat_rates, dtype=float))
+
+def _identifiers(data_frame):
+    return [column for column in ('barcode', 'asin', 'title') if column in data_frame]
+
+def _chunks(data_frame, buy_box_factors, buy_price_factors, vat_rates, max_cells):
+    # Yields (first row, {column: float array}) for chunks of products sized to `max_cells`
+    missing = [column for column in REQUIRED_COLUMNS if column not in data_frame]
+    if missing:
+        raise ValueError(f"Enriched data is missing required columns: {', '.join(missing)}")
+
+    grid_points = len(buy_box_factors) * len(buy_price_factors) * len(vat_rates)
+    chunk_rows = max(1, max_cells // grid_points)
+    click.echo(f"  Sweeping {len(data_frame)} products x {grid_points} scenarios in chunks of {chunk_rows}...")
+
+    columns = {
+        column: pd.to_numeric(data_frame[column], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        for column in REQUIRED_COLUMNS
+    }
+    for start in range(0, len(data_frame), chunk_rows):
+        yield start, {name: values[start:start + chunk_rows] for name, values in columns.items()}
+
+def _sweep_chunk(profit_calculator, columns, buy_box_factors, buy_price_factors, vat_rates, target_roi):
+    buy_box_price = columns['buy_box_price']
+    fba_fee = columns['fba_fee']
+    referral_fee_percentage = columns['referral_fee_percentage']
+    supplier_buy_price = columns['supplier_buy_price']
+
+    # Only the count of profitable scenarios is kept, so the grid is built one VAT rate at a
+    # time. Axes: (product, buy box scenario, buy price scenario)
+    buy_box_grid = buy_box_price[:, None, None] * (1 + buy_box_factors[None, :, None])
+    buy_price_grid = supplier_buy_price[:, None, None] * (1 + buy_price_factors[None, None, :])
+    profitable = np.zeros(len(buy_box_price))
+    for vat_rate in vat_rates:
+        profit = profit_calculator.profit_array(
+            buy_box_grid, fba_fee[:, None, None], referral_fee_percentage[:, None, None], buy_price_grid, vat_rate
+        )
+        profitable += (profit > 0).sum(axis=(1, 2))
+
+    # Rows with no computable ROI stay NaN: missing inputs, or no non-zero buy price to divide by
+    has_roi = (
+        ~np.isnan(buy_box_price) & ~np.isnan(fba_fee) & ~np.isnan(referral_fee_percentage)
+        & (supplier_buy_price != 0) & ~np.isnan(supplier_buy_price) & (buy_price_factors != -1).any()
+    )
+
+    # Profit is zero where the buy price equals the net proceeds of a sale:
+    # buy box price - FBA fee - referral fee (VAT only scales a zero margin).
+    net_proceeds = buy_box_price * (1 - referral_fee_percentage) - fba_fee
+    low_buy_box = buy_box_price * (1 + buy_box_factors.min())
+    net_proceeds_low = low_buy_box * (1 - referral_fee_percentage) - fba_fee
+
+    summary = {
+        'break_even_buy_price': np.round(net_proceeds, 2),
+        'break_even_buy_price_low': np.round(net_proceeds_low, 2),
+    }
+    # ROI (as a fraction) = net proceeds * (1 - VAT) / buy price - (1 - VAT), solved for the buy price
+    target = target_roi / 100
+    for vat_rate in vat_rates:
+        keep = 1 - vat_rate
+        summary[f'max_buy_price_for_target_roi_vat_{vat_rate:g}'] = np.round(net_proceeds * keep / (target + keep), 2)
+    # The same equation solved for the buy box price at today's supplier price
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for vat_rate in vat_rates:
+            keep = 1 - vat_rate
+            buy_box_needed = (supplier_buy_price * (1 + target / keep) + fba_fee) / (1 - referral_fee_percentage)
+            summary[f'min_buy_box_price_for_target_roi_vat_{vat_rate:g}'] = np.round(buy_box_needed, 2)
+
+    grid_points = len(buy_box_factors) * len(buy_price_factors) * len(vat_rates)
+    summary['profitable_share'] = np.where(has_roi, profitable / grid_points, np.nan)
+    return pd.DataFrame(summary)
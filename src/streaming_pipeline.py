@@ -0,0 +1,202 @@
+import json
+import os
+import pandas as pd
+from src.enrichment_engine import build_enriched_frame
+
+# Explicit dtypes for the cleansed supplier columns. Barcodes and ASINs must stay strings
+# (leading zeros, no float coercion) and prices are parsed once as float64 instead of
+# letting pandas infer types chunk by chunk. Numeric cells that do not parse (e.g.
+# "£5.00") become NaN, in CSV and Excel input alike, rather than failing the run.
+SUPPLIER_DTYPES = {
+    'barcode': 'string',
+    'asin': 'string',
+    'buy_price': 'float64',
+    'vat_rate': 'float64',
+    'pack_size': 'float64',
+    'supplier_image_url': 'string',
+    'supplier_image_path': 'string',
+}
+
+NESTED_COLUMNS = ['keepa_data', 'jungle_scout_data']
+
+DEFAULT_CHUNKSIZE = 5000
+
+def read_supplier_chunks(supplier_file, chunksize=DEFAULT_CHUNKSIZE):
+    # Yields DataFrames of at most `chunksize` rows, so only one chunk of the input is
+    # held in memory at a time. CSV is read with pandas' chunked reader; Excel workbooks
+    # are streamed row by row with openpyxl's read-only mode.
+    if supplier_file.endswith(('.xlsx', '.xlsm')):
+        yield from _read_excel_chunks(supplier_file, chunksize)
+        return
+    # Numeric columns are read as text and coerced, as for Excel
+    dtypes = {column: 'string' for column in SUPPLIER_DTYPES}
+    for chunk in pd.read_csv(supplier_file, chunksize=chunksize, dtype=dtypes):
+        yield _numeric_columns(chunk)
+
+def _read_excel_chunks(supplier_file, chunksize):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(supplier_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(name) if name is not None else f'column_{index}' for index, name in enumerate(next(rows, ()))]
+        buffer = []
+        for values in rows:
+            buffer.append(values)
+            if len(buffer) >= chunksize:
+                yield _typed_frame(buffer, header)
+                buffer = []
+        if buffer:
+            yield _typed_frame(buffer, header)
+    finally:
+        workbook.close()
+
+def _numeric_columns(frame):
+    for column, dtype in SUPPLIER_DTYPES.items():
+        if dtype == 'float64' and column in frame:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('float64')
+    return frame
+
+def _typed_frame(rows, header):
+    frame = _numeric_columns(pd.DataFrame(rows, columns=header))
+    for column, dtype in SUPPLIER_DTYPES.items():
+        if column not in frame or dtype == 'float64':
+            continue
+        # Excel stores long barcodes as numbers; render integers without a trailing ".0"
+        frame[column] = frame[column].map(
+            lambda value: None if value is None else str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        ).astype(dtype)
+    return frame
+
+
+class ResultWriter:
+    # Appends processed chunks to the output as they are produced, so partial results can
+    # be read while a run is still going.
+    #   *.csv      one CSV file, header written once, flushed after every chunk
+    #   *.parquet  a directory of part files (part-00000.parquet, ...), readable at any
+    #              point with pd.read_parquet(path)
+    # Nested API payloads (keepa_data, jungle_scout_data) are stored as JSON strings.
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.format = 'parquet' if output_file.endswith('.parquet') else 'csv'
+        self.rows_written = 0
+        self._parts = 0
+        if self.format == 'parquet':
+            os.makedirs(output_file, exist_ok=True)
+            for name in os.listdir(output_file):
+                if name.startswith('part-') and name.endswith(('.parquet', '.parquet.tmp')):
+                    os.remove(os.path.join(output_file, name)) # Parts left over from an earlier run
+        else:
+            os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+    def write(self, data_frame):
+        data_frame = self._normalise(data_frame)
+        if self.format == 'parquet':
+            part_file = os.path.join(self.output_file, f'part-{self._parts:05d}.parquet')
+            data_frame.to_parquet(part_file + '.tmp', index=False)
+            os.replace(part_file + '.tmp', part_file) # Readers never see half-written parts
+        else:
+            with open(self.output_file, 'a', newline='', encoding='utf-8') as handle:
+                data_frame.to_csv(handle, index=False, header=self.rows_written == 0)
+        self._parts += 1
+        self.rows_written += len(data_frame)
+
+    @staticmethod
+    def _normalise(data_frame):
+        # Keep column types stable across chunks: numbers as float64 (a chunk without any
+        # value must not turn a column into nulls of another type), everything else as strings.
+        data_frame = data_frame.copy()
+        for column in data_frame.columns:
+            values = data_frame[column]
+            if column in NESTED_COLUMNS:
+                data_frame[column] = values.map(lambda value: json.dumps(value) if isinstance(value, (dict, list)) else None)
+            elif pd.api.types.is_bool_dtype(values):
+                continue
+            elif pd.api.types.is_numeric_dtype(values):
+                data_frame[column] = values.astype('float64')
+            else:
+                data_frame[column] = values.astype('string')
+        return data_frame
+
+def read_results(output_file):
+    # Reads what ResultWriter wrote (a CSV file or a directory of Parquet parts) and turns
+    # the nested JSON columns back into dicts
+    if output_file.endswith('.parquet'):
+        data_frame = pd.read_parquet(output_file)
+    else:
+        data_frame = pd.read_csv(output_file, dtype={'barcode': 'string', 'asin': 'string'})
+    for column in NESTED_COLUMNS:
+        if column in data_frame:
+            data_frame[column] = data_frame[column].map(lambda value: json.loads(value) if isinstance(value, str) else None)
+    return data_frame
+
+
+class StreamingPipeline:
+    # Reads the supplier file chunk by chunk, enriches and scores each chunk, and writes it
+    # out before the next one is read. Memory stays bounded by `chunksize` regardless of
+    # the size of the input. With an ImageStore, supplier and Amazon images are downloaded
+    # in the background while the chunk is being enriched, so image matching finds them
+    # already stored. Stage timings go to the run's Instrumentation, which is the
+    # enrichment engine's unless another is given.
+    def __init__(self, enrichment_engine, profit_calculator, image_matcher=None, chunksize=DEFAULT_CHUNKSIZE, output_columns=None, image_store=None, keepa_history=None, instrumentation=None):
+        self.enrichment_engine = enrichment_engine
+        self.instrumentation = instrumentation or enrichment_engine.api_integrator.instrumentation
+        self.keepa_history = keepa_history
+        self.profit_calculator = profit_calculator
+        self.image_matcher = image_matcher
+        self.image_store = image_store
+        self.chunksize = chunksize
+        self.output_columns = output_columns
+
+    def run(self, supplier_file, output_file):
+        rows_read = 0
+        writer = ResultWriter(output_file)
+        for chunk_number, supplier_df in enumerate(read_supplier_chunks(supplier_file, self.chunksize)):
+            rows_read += len(supplier_df)
+            processed_df = self.process_chunk(supplier_df)
+            with self.instrumentation.stage('write_results'):
+                writer.write(processed_df)
+            self.instrumentation.count('rows_read', len(supplier_df))
+            self.instrumentation.log(
+                f"Chunk {chunk_number + 1}: {rows_read} rows read, {writer.rows_written} rows written to {output_file}",
+                level='info', chunk=chunk_number + 1, rows_read=rows_read, rows_written=writer.rows_written
+            )
+        return {'rows_read': rows_read, 'rows_written': writer.rows_written}
+
+    def process_chunk(self, supplier_df):
+        on_result = None
+        if self.image_store is not None:
+            for column in ('supplier_image_path', 'supplier_image_url'):
+                if column in supplier_df:
+                    self.image_store.prefetch(supplier_df[column].dropna())
+            on_result = self._prefetch_amazon_image
+        enriched_rows = self.enrichment_engine.enrich(supplier_df, on_result=on_result)
+        enriched_df = build_enriched_frame(enriched_rows)
+        if self.keepa_history is not None:
+            with self.instrumentation.stage('history_stats'):
+                enriched_df = self.keepa_history.add_stats(enriched_df)
+        with self.instrumentation.stage('scoring'):
+            processed_df = self.profit_calculator.score_dataframe(enriched_df)
+
+        if self.image_matcher is not None:
+            # Image Matching: scores every supplier/Amazon image pair in the chunk and drops
+            # confirmed mismatches. Local supplier images are preferred; with an image store
+            # the supplier image URL is used for rows without one.
+            supplier_column = 'supplier_image_path'
+            if self.image_store is not None:
+                supplier_column = 'supplier_image'
+                processed_df['supplier_image'] = processed_df['supplier_image_path'].fillna(processed_df['supplier_image_url'])
+            with self.instrumentation.stage('image_matching'):
+                processed_df = self.image_matcher.reduce_false_positives(processed_df, supplier_column=supplier_column)
+
+        if self.output_columns:
+            processed_df = processed_df[[column for column in self.output_columns if column in processed_df]]
+        return processed_df
+
+    def _prefetch_amazon_image(self, outcome):
+        # Called from the enrichment worker threads as each row completes
+        image_url = outcome['amazon_data'].get('main_image_url')
+        if image_url:
+            self.image_store.prefetch([image_url])
@@ -0,0 +1,20 @@
+import pandas as pd
+from benchmarks.bench_enrichment import UNLIMITED
+from benchmarks.mock_api_server import MockAPIServer
+from src.api_integrator import APIIntegrator
+from src.enrichment_engine import EnrichmentEngine, flatten_enriched, supplier_row_keys
+
+def test_duplicate_barcodes_keep_separate_outcomes():
+    # One product listed at two prices must give two outcomes with their own keys and records
+    supplier_df = pd.DataFrame({'barcode': ['5000000000001', '5000000000001', None],
+                                'asin': [None, None, None], 'buy_price': [5.0, 7.0, 4.0]})
+    assert list(supplier_row_keys(supplier_df)) == ['5000000000001', '5000000000001#2', 'row:2']
+    with MockAPIServer(latency=0) as server:
+        api_integrator = APIIntegrator('amazon-key', 'keepa-key', 'jungle-scout-key',
+            sp_api_base_url=server.base_url, keepa_base_url=server.base_url, jungle_scout_base_url=server.base_url)
+        outcomes = EnrichmentEngine(api_integrator, limits=UNLIMITED).enrich_outcomes(supplier_df)
+        api_integrator.http_client.close()
+    assert [outcome['key'] for outcome in outcomes] == ['5000000000001', '5000000000001#2', 'row:2']
+    assert [outcome['supplier_buy_price'] for outcome in outcomes] == [5.0, 7.0, 4.0]
+    records = [flatten_enriched(outcome) for outcome in outcomes[:2]]
+    assert [record['supplier_buy_price'] for record in records] == [5.0, 7.0]
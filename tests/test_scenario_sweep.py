@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+from src import scenario_sweep
+
+def test_profitable_share_matches_the_grid():
+    # The summary counts profitable scenarios without building the grid; the long-format
+    # grid must agree with it, chunk boundaries included
+    enriched_df = pd.DataFrame({'barcode': ['1', '2', '3', '4'], 'buy_box_price': [20.0, 12.0, np.nan, 15.0],
+                                'fba_fee': [3.0, 2.5, 3.0, 2.0], 'referral_fee_percentage': [0.15, 0.15, 0.15, 0.15],
+                                'supplier_buy_price': [8.0, 9.0, 5.0, 0.0]})
+    summary = scenario_sweep.sweep_scenarios(enriched_df, max_cells=1000)
+    grid = pd.concat(scenario_sweep.sweep_grid(enriched_df, max_cells=1000), ignore_index=True)
+    assert len(grid) == len(enriched_df) * 31 * 31 * 2
+    has_roi = grid.groupby('barcode', sort=False)['roi'].count() > 0
+    share = (grid['profit'] > 0).groupby(grid['barcode'], sort=False).mean().where(has_roi)
+    np.testing.assert_allclose(summary['profitable_share'], share.to_numpy())
+    assert summary['profitable_share'].isna().tolist() == [False, False, True, True]
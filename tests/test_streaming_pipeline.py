@@ -0,0 +1,26 @@
+from benchmarks.bench_enrichment import UNLIMITED
+from benchmarks.mock_api_server import MockAPIServer
+from src.api_integrator import APIIntegrator
+from src.enrichment_engine import EnrichmentEngine
+from src.streaming_pipeline import read_supplier_chunks
+
+def test_blank_barcode_and_asin_cells_enrich(tmp_path):
+    # CSV string columns read blank cells as pd.NA, which must count as missing rather
+    # than fail when compared with ''
+    supplier_file = tmp_path / 'supplier.csv'
+    supplier_file.write_text('barcode,asin,buy_price\n5000000000001,,5\n,B000000099,3\n,,4\n')
+    chunk = next(read_supplier_chunks(str(supplier_file)))
+
+    with MockAPIServer(latency=0) as server:
+        api_integrator = APIIntegrator(
+            'amazon-key', 'keepa-key', 'jungle-scout-key',
+            sp_api_base_url=server.base_url, keepa_base_url=server.base_url, jungle_scout_base_url=server.base_url
+        )
+        outcomes = EnrichmentEngine(api_integrator, limits=UNLIMITED).enrich_outcomes(chunk)
+        api_integrator.http_client.close()
+
+    assert [(outcome['asin'], outcome['status']) for outcome in outcomes] == [
+        ('B000000001', 'ok'),  # ASIN from the barcode
+        ('B000000099', 'ok'),  # ASIN given, no barcode
+        (None, 'skipped'),     # Neither
+    ]